@@ -0,0 +1,116 @@
+"""Measure the latency of database reads during sustained writes.
+
+Reader processes use the read-only connection pool of ``maildump.db`` to
+load the message list and the newest message, like the web interface does.
+Each run takes place once without and once with a writer process which
+stores batches of large messages, including their parts, as fast as it
+can. Without WAL, readers would have to wait for every write transaction.
+
+Run it from the repository root::
+
+    python -m benchmarks.db_concurrency [--readers N] [--duration SECONDS] [--batch N] [--size KIB]
+"""
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
+from io import BytesIO
+
+
+def make_message(i, size):
+    msg = EmailMessage()
+    msg['From'] = 'sender@example.com'
+    msg['To'] = 'recipient@example.com'
+    msg['Subject'] = f'Concurrency test message {i}'
+    msg.set_content('Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n' * 40)
+    msg.add_attachment(os.urandom(size), maintype='application', subtype='octet-stream', filename='data.bin')
+    return msg.as_bytes()
+
+
+def write(path, batch, size, ready, stop):
+    from maildump import db
+
+    db.connect(path)
+    message = make_message(0, size)
+    headers = BytesHeaderParser().parsebytes(message)
+    ready.wait()
+    while not stop.is_set():
+        bodies = [BytesIO(message) for __ in range(batch)]
+        message_ids = db.add_messages([('sender@example.com', ['recipient@example.com'], b, headers) for b in bodies])
+        results = []
+        for message_id, body in zip(message_ids, bodies, strict=True):
+            body.seek(0)
+            results.append((message_id, *db.extract_message_parts(body)))
+        db.add_message_parts(results)
+    db.disconnect()
+
+
+def read(path, ready, stop, results):
+    from maildump import db
+
+    db.connect(path, readers=1)
+    latencies = []
+    ready.wait()
+    while not stop.is_set():
+        start = time.perf_counter()
+        messages = db.get_messages(lightweight=True, limit=50)
+        if messages:
+            db.get_message(messages[0]['id'], info=True)
+        latencies.append(time.perf_counter() - start)
+    db.disconnect()
+    results.put(latencies)
+
+
+def run(path, readers, duration, batch, size, writer):
+    ctx = multiprocessing.get_context('spawn')
+    ready = ctx.Event()
+    stop = ctx.Event()
+    results = ctx.Queue()
+    procs = [ctx.Process(target=read, args=(path, ready, stop, results)) for __ in range(readers)]
+    if writer:
+        procs.append(ctx.Process(target=write, args=(path, batch, size, ready, stop)))
+    for proc in procs:
+        proc.start()
+    # give the processes time to connect
+    time.sleep(1)
+    ready.set()
+    time.sleep(duration)
+    stop.set()
+    latencies = sorted(x for __ in range(readers) for x in results.get())
+    for proc in procs:
+        proc.join()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=4, help='Number of reader processes (default: 4)')
+    parser.add_argument('--duration', type=float, default=5, help='Duration of each run in seconds (default: 5)')
+    parser.add_argument('--batch', type=int, default=50, help='Messages per write transaction (default: 50)')
+    parser.add_argument('--size', type=int, default=200, help='Attachment size in KiB (default: 200)')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'maildump.db')
+        from maildump import db
+
+        # create the database before the processes race to do so
+        db.connect(path)
+        db.disconnect()
+        print(f'{args.readers} readers, batches of {args.batch} messages with {args.size} KiB attachments')
+        for writer in (False, True):
+            latencies = run(path, args.readers, args.duration, args.batch, args.size * 1024, writer)
+            p50 = statistics.median(latencies) * 1000
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000
+            print(
+                f'{"with writer" if writer else "idle":<12} {len(latencies):8} reads  '
+                f'p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  max {latencies[-1] * 1000:7.2f} ms'
+            )
+
+
+if __name__ == '__main__':
+    main()
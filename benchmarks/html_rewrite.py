@@ -0,0 +1,59 @@
+"""Compare the cid link rewriters used for HTML message bodies.
+
+Run it from the repository root::
+
+    python -m benchmarks.html_rewrite [--rows N] [--runs N]
+"""
+
+import argparse
+import timeit
+from functools import partial
+
+import bs4
+
+from maildump.web import _fix_cid_links, _rewrite_cid_links, app
+
+
+def make_newsletter(rows):
+    items = '\n'.join(
+        f"""
+        <tr>
+          <td class="item" style="padding: 8px"><img src="cid:img{i}@example.com" width="64" alt="Item {i}"></td>
+          <td><a href="https://example.com/item/{i}?utm_source=newsletter&amp;utm_medium=email">Item {i}</a>
+            <p>Lorem ipsum dolor sit amet, <b>consectetur</b> adipiscing elit &ndash; sed do eiusmod.</p></td>
+        </tr>
+        """
+        for i in range(rows)
+    )
+    return f"""<!DOCTYPE html>
+    <html><head><meta charset="utf-8"><title>Newsletter</title>
+    <style>.header {{ background: url(cid:header@example.com) }} .item {{ border: 1px solid #ccc }}</style>
+    </head><body><table class="header"><tr><td><img src="cid:logo@example.com"></td></tr></table>
+    <table>{items}</table></body></html>"""
+
+
+def rewrite_html5lib(text):
+    soup = bs4.BeautifulSoup(text, 'html5lib')
+    _fix_cid_links(soup, 1)
+    return soup.encode('utf-8')
+
+
+def rewrite_fast(text):
+    return _rewrite_cid_links(text, 1).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500, help='Number of items in the newsletter (default: 500)')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs per rewriter (default: 5)')
+    args = parser.parse_args()
+    text = make_newsletter(args.rows)
+    print(f'Document size: {len(text)} characters, {args.rows + 2} cid references')
+    with app.test_request_context():
+        for func in (rewrite_html5lib, rewrite_fast):
+            best = min(timeit.repeat(partial(func, text), number=1, repeat=args.runs))
+            print(f'{func.__name__:<18} {best * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Compare JSON encoders and content codings for the message list.
+
+Run it from the repository root::
+
+    python -m benchmarks.json_encode [--messages N] [--runs N]
+"""
+
+import argparse
+import json
+import timeit
+from datetime import datetime, timedelta
+from functools import partial
+
+from maildump import util
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def make_messages(count):
+    start = datetime(2024, 1, 1)
+    return {
+        'messages': [
+            {
+                'id': i,
+                'sender_envelope': f'sender{i % 50}@example.com',
+                'sender_message': f'"Sender {i % 50}" <sender{i % 50}@example.com>',
+                'recipients_envelope': [f'user{i % 200}@example.org'],
+                'recipients_message_to': [f'"User {i % 200}" <user{i % 200}@example.org>'],
+                'recipients_message_cc': [],
+                'recipients_message_bcc': [],
+                'subject': f'Your order #{100000 + i} has been shipped',
+                'size': 4000 + i % 3000,
+                'type': 'multipart/alternative',
+                'created_at': start + timedelta(seconds=i * 37),
+                'peer': '127.0.0.1:40000',
+                'formats': {'source': f'/messages/{i}.source', 'plain': f'/messages/{i}.plain'},
+                'attachments': [],
+            }
+            for i in range(count)
+        ]
+    }
+
+
+def encode_indented(data):
+    return json.dumps(data, default=util._json_default, indent=4).encode('utf-8')
+
+
+def encode_compact(data):
+    return json.dumps(data, default=util._json_default, separators=(',', ':')).encode('utf-8')
+
+
+def encode_orjson(data):
+    return orjson.dumps(data, default=util._json_default, option=orjson.OPT_NAIVE_UTC)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=10000, help='Number of messages (default: 10000)')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs per encoder (default: 5)')
+    args = parser.parse_args()
+    data = make_messages(args.messages)
+
+    encoders = [encode_indented, encode_compact]
+    if orjson is not None:
+        encoders.append(encode_orjson)
+    print('Encoders:')
+    for func in encoders:
+        best = min(timeit.repeat(partial(func, data), number=1, repeat=args.runs))
+        print(f'  {func.__name__:<16} {best * 1000:8.1f} ms {len(func(data)):>10} bytes')
+
+    payload = util.json_dumps(data)
+    codings = [('gzip', lambda: util._get_compressor('gzip'))]
+    if brotli is not None:
+        codings.append(('br', lambda: util._get_compressor('br')))
+    print(f'Content codings ({len(payload)} bytes of compact JSON):')
+    for name, get_compressor in codings:
+
+        def run(get_compressor=get_compressor):
+            compress, flush = get_compressor()
+            return compress(payload) + flush()
+
+        best = min(timeit.repeat(run, number=1, repeat=args.runs))
+        print(f'  {name:<16} {best * 1000:8.1f} ms {len(run()):>10} bytes')
+
+
+if __name__ == '__main__':
+    main()
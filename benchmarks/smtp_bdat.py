@@ -0,0 +1,85 @@
+"""Compare the throughput of DATA and BDAT for large messages.
+
+The SMTP server runs in a separate process and discards the messages it
+receives, so only receiving the message data is measured.
+
+Run it from the repository root::
+
+    python -m benchmarks.smtp_bdat [--size MIB] [--messages N]
+"""
+
+import argparse
+import multiprocessing
+import smtplib
+import socket
+import time
+
+PORT = 11025
+
+
+def serve(port):
+    from maildump.smtp import SMTPServer
+
+    def handler(sender, recipients, body):
+        body.close()
+
+    SMTPServer(('127.0.0.1', port), handler).serve_forever()
+
+
+def make_message(size):
+    line = b'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.\r\n'
+    # some lines need dot-stuffing
+    body = (line * 9 + b'.' + line) * (size // (len(line) * 10 + 1) + 1)
+    return b'Subject: Large message\r\nFrom: sender@example.com\r\nTo: recipient@example.com\r\n\r\n' + body[:size]
+
+
+def send_data(smtp, message):
+    smtp.sendmail('sender@example.com', ['recipient@example.com'], message)
+
+
+def send_bdat(smtp, message):
+    smtp.mail('sender@example.com')
+    smtp.rcpt('recipient@example.com')
+    smtp.send(b'BDAT %d LAST\r\n' % len(message))
+    smtp.send(message)
+    code, reply = smtp.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, reply)
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start listening on port {port}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=20, help='Message size in MiB (default: 20)')
+    parser.add_argument('--messages', type=int, default=10, help='Number of messages per command (default: 10)')
+    args = parser.parse_args()
+    message = make_message(args.size * 1048576)
+    server = multiprocessing.get_context('spawn').Process(target=serve, args=(PORT,), daemon=True)
+    server.start()
+    try:
+        wait_for_port(PORT)
+        with smtplib.SMTP('127.0.0.1', PORT) as smtp:
+            smtp.ehlo()
+            for func in (send_data, send_bdat):
+                start = time.perf_counter()
+                for __ in range(args.messages):
+                    func(smtp, message)
+                elapsed = time.perf_counter() - start
+                rate = len(message) * args.messages / elapsed / 1048576
+                print(f'{func.__name__:<10} {elapsed / args.messages * 1000:8.1f} ms/message {rate:8.1f} MiB/s')
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
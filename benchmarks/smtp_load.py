@@ -0,0 +1,130 @@
+"""Measure how SMTP throughput scales with the number of SMTP workers.
+
+For every worker count a MailDump server is started, and several client
+processes send multipart messages over concurrent SMTP connections. Both
+the number of messages acknowledged per second and the number of messages
+per second which have been stored completely, including their parts, are
+reported. Clients retry messages the server is too busy to accept, like
+mail servers do.
+
+Run it from the repository root::
+
+    python -m benchmarks.smtp_load [--workers 0 1 2 4] [--messages N] [--clients N]
+"""
+
+import argparse
+import os
+import smtplib
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from email.message import EmailMessage
+from multiprocessing import Pool
+
+SMTP_PORT = 11025
+HTTP_PORT = 11080
+# seconds to wait before sending a message again which has been rejected
+RETRY_DELAY = 0.05
+
+
+def make_message(i):
+    msg = EmailMessage()
+    msg['From'] = 'sender@example.com'
+    msg['To'] = 'recipient@example.com'
+    msg['Subject'] = f'Load test message {i}'
+    text = f'Hello,\n\nthis is message {i}.\n\n' + 'Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n' * 40
+    msg.set_content(text)
+    msg.add_alternative(f'<html><body><p>{text.replace(chr(10), "<br>")}</p></body></html>', subtype='html')
+    msg.add_attachment(os.urandom(16384), maintype='application', subtype='octet-stream', filename='data.bin')
+    return msg.as_bytes()
+
+
+def send_messages(count):
+    message = make_message(count)
+    with smtplib.SMTP('127.0.0.1', SMTP_PORT) as smtp:
+        for __ in range(count):
+            while True:
+                try:
+                    smtp.sendmail('sender@example.com', ['recipient@example.com'], message)
+                    break
+                except smtplib.SMTPDataError as exc:
+                    if exc.smtp_code // 100 != 4:
+                        raise
+                    time.sleep(RETRY_DELAY)
+    return count
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start listening on port {port}')
+
+
+def wait_for_parts(path, count, timeout=600):
+    """Wait until the parts of `count` messages have been stored."""
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            if conn.execute('SELECT COUNT(*) FROM message WHERE parts_ready').fetchone()[0] >= count:
+                return
+            time.sleep(0.01)
+    finally:
+        conn.close()
+    raise RuntimeError(f'The parts of {count} messages have not been stored in time')
+
+
+def run(workers, messages, clients):
+    """Get the number of messages acknowledged and stored per second."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'maildump.db')
+        cmd = [
+            sys.executable,
+            '-c',
+            'from maildump_runner.main import main; main()',
+            '--foreground',
+            f'--smtp-port={SMTP_PORT}',
+            f'--http-port={HTTP_PORT}',
+            f'--smtp-workers={workers}',
+            f'--db={path}',
+        ]
+        # the daemon context changes the working directory
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        server = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            # the web server is started last, once the database exists
+            wait_for_port(HTTP_PORT)
+            with Pool(clients) as pool:
+                start = time.perf_counter()
+                sent = sum(pool.map(send_messages, [messages // clients] * clients))
+                acknowledged = time.perf_counter() - start
+            wait_for_parts(path, sent)
+            stored = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+    return sent / acknowledged, sent / stored
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4], help='SMTP worker counts to test')
+    parser.add_argument('--messages', type=int, default=2000, help='Number of messages per run (default: 2000)')
+    parser.add_argument('--clients', type=int, default=8, help='Number of concurrent clients (default: 8)')
+    args = parser.parse_args()
+    print(f'{os.cpu_count()} CPUs, {args.messages} messages, {args.clients} clients')
+    for workers in args.workers:
+        acknowledged, stored = run(workers, args.messages, args.clients)
+        print(f'{workers:>2} workers {acknowledged:10.1f} acknowledged/s {stored:10.1f} stored/s')
+
+
+if __name__ == '__main__':
+    main()
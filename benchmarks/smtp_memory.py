@@ -0,0 +1,142 @@
+"""Measure the peak memory usage of the server while receiving large messages.
+
+For every source tree a MailDump server is started once without receiving
+anything and once for every message size, receiving messages of that size.
+The difference of the peak RSS (``VmHWM``, so this only works on Linux) of the server
+process is the memory needed to receive and store a message, which is
+also reported as a multiple of the message size. The messages are stored
+in a database file so they do not count towards the RSS themselves.
+
+Half of every message is a text part, the other half a base64-encoded
+attachment.
+
+To compare the current code with an older revision, extract it first::
+
+    git archive <revision> maildump maildump_runner | tar -x -C /tmp/before
+
+Run it from the repository root::
+
+    python -m benchmarks.smtp_memory [--size MIB ...] [--messages N] [--tree PATH ...]
+"""
+
+import argparse
+import base64
+import os
+import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SMTP_PORT = 11025
+HTTP_PORT = 11080
+# prints the peak RSS once the server has been stopped; unlike ``ru_maxrss``
+# it does not include the memory of the benchmark process, which is kept
+# across the exec of the server
+SERVER_CODE = """
+import atexit, re, sys
+def print_peak_rss():
+    with open('/proc/self/status') as f:
+        print(re.search(r'VmHWM:\\s+(\\d+)', f.read()).group(1), file=sys.stderr, flush=True)
+atexit.register(print_peak_rss)
+from maildump_runner.main import main
+main()
+"""
+
+
+def make_message(size):
+    line = b'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.\r\n'
+    # some lines need dot-stuffing
+    text = (line * 9 + b'.' + line) * (size // 2 // (len(line) * 10 + 1) + 1)
+    # 57 bytes are encoded as a line of 76 characters
+    attachment = base64.encodebytes(os.urandom(size // 2 * 57 // 78)).replace(b'\n', b'\r\n')
+    return b'\r\n'.join(
+        (
+            b'Subject: Large message',
+            b'From: sender@example.com',
+            b'To: recipient@example.com',
+            b'Content-Type: multipart/mixed; boundary=boundary',
+            b'',
+            b'--boundary',
+            b'Content-Type: text/plain',
+            b'',
+            text[: size // 2],
+            b'--boundary',
+            b'Content-Type: application/octet-stream',
+            b'Content-Transfer-Encoding: base64',
+            b'Content-Disposition: attachment; filename=data.bin',
+            b'',
+            attachment,
+            b'--boundary--',
+            b'',
+        )
+    )
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start listening on port {port}')
+
+
+def run(tree, message, messages):
+    """Get the peak RSS of a server receiving `messages` messages in KiB."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cmd = [
+            sys.executable,
+            '-c',
+            SERVER_CODE,
+            '--foreground',
+            f'--smtp-port={SMTP_PORT}',
+            f'--http-port={HTTP_PORT}',
+            f'--db={os.path.join(tmpdir, "maildump.db")}',
+        ]
+        # the daemon context changes the working directory
+        tree = os.path.abspath(tree)
+        env = dict(os.environ, PYTHONPATH=tree)
+        server = subprocess.Popen(cmd, cwd=tree, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            # the web server is started last
+            wait_for_port(HTTP_PORT)
+            if messages:
+                with smtplib.SMTP('127.0.0.1', SMTP_PORT) as smtp:
+                    for __ in range(messages):
+                        smtp.sendmail('sender@example.com', ['recipient@example.com'], message)
+                # give the server a moment to store the last message
+                time.sleep(1)
+        finally:
+            server.terminate()
+            __, stderr = server.communicate()
+    return int(stderr.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--size', type=int, nargs='+', default=[1, 5, 20], help='Message sizes in MiB (default: 1 5 20)'
+    )
+    parser.add_argument('--messages', type=int, default=3, help='Number of messages of each size (default: 3)')
+    parser.add_argument('--tree', nargs='+', default=['.'], help='Source trees to compare (default: .)')
+    args = parser.parse_args()
+    messages = [make_message(size * 1048576) for size in args.size]
+    print(f'{args.messages} messages of each size')
+    for tree in args.tree:
+        idle = run(tree, b'', 0)
+        print(f'{tree:<30} idle {idle / 1024:8.1f} MiB')
+        for message in messages:
+            peak = run(tree, message, args.messages)
+            size = len(message) / 1024
+            print(
+                f'{len(message) / 1048576:8.1f} MiB messages  peak {peak / 1024:8.1f} MiB  '
+                f'+{(peak - idle) / 1024:8.1f} MiB  ({(peak - idle) / size:4.1f}x the message size)'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,129 @@
-import asyncore
-import gevent
+from gevent.event import Event
 from gevent.pywsgi import WSGIServer
 from logbook import Logger
 
-from maildump.db import connect, create_tables, disconnect
-from maildump.smtp import SMTPServer, smtp_handler
+from maildump import db, ingest, retention, smtp_workers, snapshot, sync
+from maildump.smtp import SPOOL_THRESHOLD, SMTPServer, smtp_handler
+from maildump.util import reuse_port_listener
 from maildump.web import app
 
 log = Logger(__name__)
 stopper = None
+HTTP_BACKLOG = 128
 
 
-def start(http_host, http_port, smtp_host, smtp_port, db_path=None):
+def start(
+    http_host,
+    http_port,
+    smtp_host,
+    smtp_port,
+    db_path=None,
+    db_synchronous=db.SYNCHRONOUS,
+    db_cache_size=db.CACHE_SIZE,
+    db_mmap_size=db.MMAP_SIZE,
+    db_readers=db.READERS,
+    part_storage=db.PART_STORAGE,
+    part_cache_size=db.PART_CACHE_SIZE,
+    compression=None,
+    smtp_backlog=None,
+    smtp_max_connections=None,
+    smtp_spool_threshold=SPOOL_THRESHOLD,
+    ingest_queue_size=ingest.QUEUE_SIZE,
+    ingest_batch_size=ingest.BATCH_SIZE,
+    ingest_max_delay=ingest.MAX_DELAY,
+    parse_workers=ingest.PARSE_WORKERS,
+    max_messages=None,
+    max_bytes=None,
+    max_age=None,
+    role='all',
+    reuse_port=False,
+    smtp_workers_count=0,
+    snapshot_interval=None,
+):
+    """Run MailDump until `stop` is called.
+
+    With `role` set to ``smtp`` only the SMTP server is started, with
+    ``web`` only the web server. Several processes with different roles
+    may share a file database, e.g. one receiving messages and several
+    serving the web interface on the same port using `reuse_port`. Web
+    processes only read the database and cannot delete messages.
+
+    With `smtp_workers_count` set, that many worker processes receive and
+    decode messages instead of this process.
+
+    With `snapshot_interval` set, the database is kept in memory and saved
+    to `db_path` in that interval and when stopping.
+    """
     global stopper
+    http_server = smtp_server = None
+    if role != 'web' and smtp_workers_count:
+        # forked before anything else is started or opened
+        log.notice(f'Starting {smtp_workers_count} smtp workers on {smtp_host}:{smtp_port}')
+        smtp_workers.start(
+            smtp_workers_count,
+            smtp_host,
+            smtp_port,
+            backlog=smtp_backlog,
+            max_connections=smtp_max_connections,
+            spool_threshold=smtp_spool_threshold,
+            part_storage=part_storage,
+            compression=compression,
+        )
     # Webserver
-    log.notice(f'Starting web server on http://{http_host}:{http_port}')
-    http_server = WSGIServer((http_host, http_port), app)
-    stopper = http_server.close
+    if role != 'smtp':
+        log.notice(f'Starting web server on http://{http_host}:{http_port}')
+        listener = reuse_port_listener(http_host, http_port, HTTP_BACKLOG) if reuse_port else (http_host, http_port)
+        http_server = WSGIServer(listener, app)
+        stopper = http_server.close
+    else:
+        stop_event = Event()
+        stopper = stop_event.set
     # SMTP server
-    log.notice(f'Starting smtp server on {smtp_host}:{smtp_port}')
-    SMTPServer((smtp_host, smtp_port), smtp_handler)
-    gevent.spawn(asyncore.loop)
+    if role != 'web' and not smtp_workers_count:
+        log.notice(f'Starting smtp server on {smtp_host}:{smtp_port}')
+        smtp_server = SMTPServer(
+            (smtp_host, smtp_port),
+            smtp_handler,
+            backlog=smtp_backlog,
+            max_connections=smtp_max_connections,
+            spool_threshold=smtp_spool_threshold,
+        )
+        smtp_server.start()
     # Database
-    connect(db_path)
-    create_tables()
-    http_server.serve_forever()  # runs until stopper is triggered
+    db.connect(
+        db_path,
+        db_synchronous,
+        db_cache_size,
+        db_mmap_size,
+        db_readers,
+        part_storage,
+        part_cache_size,
+        compression,
+        snapshot=bool(snapshot_interval),
+        read_only=role == 'web',
+    )
+    if snapshot_interval:
+        snapshot.start(snapshot_interval)
+    if role != 'web':
+        ingest.start(ingest_queue_size, ingest_batch_size, ingest_max_delay, parse_workers)
+        retention.start(max_messages, max_bytes, max_age)
+    if http_server and db_path and not snapshot_interval:
+        sync.start()
+    # runs until stopper is triggered
+    if http_server:
+        http_server.serve_forever()
+    else:
+        stop_event.wait()
     log.debug('Received stop signal')
     # Clean up
-    disconnect()
+    sync.stop()
+    if smtp_server:
+        smtp_server.stop()
+    smtp_workers.stop()
+    retention.stop()
+    ingest.stop()
+    snapshot.stop()
+    db.disconnect()
     log.notice('Terminating')
 
 
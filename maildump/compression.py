@@ -0,0 +1,104 @@
+"""Codecs used to compress stored message data.
+
+The codec used for a value is stored next to it, so databases may
+contain data compressed with different codecs (or not compressed at all).
+zstd is only available if the `zstandard` package is installed.
+"""
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Compressed data is only stored if it is smaller than this ratio of the original size
+MIN_RATIO = 0.9
+
+
+class Codec:
+    #: the name stored in the database
+    name = None
+    #: the HTTP content coding producing the same data
+    content_encoding = None
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+    def iter_decompress(self, chunks):
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    # the `deflate` content coding is the zlib format (RFC 1950)
+    content_encoding = 'deflate'
+
+    def compress(self, data):
+        return zlib.compress(data, 6)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+    def iter_decompress(self, chunks):
+        decompressor = zlib.decompressobj()
+        for chunk in chunks:
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    content_encoding = 'zstd'
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    def iter_decompress(self, chunks):
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        for chunk in chunks:
+            yield decompressor.decompress(chunk)
+
+
+CODECS = {codec.name: codec for codec in (ZlibCodec(), ZstdCodec() if zstandard else None) if codec}
+
+
+def get_codec(name):
+    """Get a codec by its name.
+
+    Raises `ValueError` if the codec is not available.
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        if name == 'zstd':
+            raise ValueError('The zstd codec requires the zstandard package') from None
+        raise ValueError(f'Unknown codec: {name}') from None
+
+
+def compress(codec, data):
+    """Compress data if it is worth it.
+
+    Returns the name of the codec used (``None`` if the data has not been
+    compressed) and the data to store.
+    """
+    if codec is None or not data:
+        return None, data
+    compressed = codec.compress(data)
+    if len(compressed) >= len(data) * MIN_RATIO:
+        return None, data
+    return codec.name, compressed
+
+
+def decompress(name, data):
+    """Decompress data stored with the codec `name`."""
+    if name is None or data is None:
+        return data
+    return get_codec(name).decompress(data)
@@ -1,143 +1,774 @@
+import hashlib
 import json
+import os
 import sqlite3
+import time
 import uuid
+from contextlib import contextmanager, suppress
+from functools import partial
+from io import BufferedReader, BytesIO, RawIOBase
+from operator import itemgetter
+from urllib.request import pathname2url
 
+import gevent
+from gevent.queue import Queue
 from logbook import Logger
 
-from maildump.util import decode_header, split_addresses
-from maildump.web_realtime import broadcast
+from maildump import metrics, migrations, mime
+from maildump.compression import compress, decompress, get_codec
+from maildump.util import LRUCache, decode_header, json_dumps, split_addresses
+from maildump.web_realtime import broadcast, use_event_log
 
 log = Logger(__name__)
+# the connection used for all writes
 _conn = None
+# read-only connections used by the web interface
+_readers = None
 
+CHUNK_SIZE = 65536
+SYNCHRONOUS = 'NORMAL'
+CACHE_SIZE = 16384
+MMAP_SIZE = 0
+READERS = 4
+PART_STORAGE = 'copy'
+PART_CACHE_SIZE = 33554432
+# Number of events kept for other processes sharing the database
+EVENT_LOG_SIZE = 10000
+# Number of pages copied before other greenlets may run while saving a snapshot
+SNAPSHOT_STEP_PAGES = 1024
+# Seconds between checks whether a read-only database has been created or upgraded
+SCHEMA_POLL_INTERVAL = 0.5
+# Seconds the row counts reported by `get_row_counts` are reused
+ROW_COUNTS_MAX_AGE = 30
+# part bodies which are stored as-is in the message source
+IDENTITY_ENCODINGS = {None, '7bit', '8bit', 'binary'}
+STREAM_PART_COLS = (
+    'id, message_id, cid, type, is_attachment, filename, charset, size, body_offset, body_length, encoding, '
+    'blob_hash, body_codec, body IS NOT NULL AS has_body, '
+    '(SELECT source_codec FROM message WHERE message.id = message_part.message_id) AS source_codec, '
+    '(SELECT length(source) FROM message WHERE message.id = message_part.message_id) AS source_length'
+)
 
-def connect(db=None):
-    global _conn
+_part_storage = PART_STORAGE
+# set if this process must not write to the database, see `connect`
+_read_only = False
+# codec used to compress message sources and stored text parts
+_codec = None
+# decoded part bodies in `index` storage mode
+_part_cache = LRUCache(PART_CACHE_SIZE)
+# caches of data derived from messages, see `register_cache`
+_caches = []
+_instance_id = None
+# events are logged in file databases, which may be shared by several processes
+_event_log = False
+# identifies the events logged by this process
+_origin = None
+_data_version = None
+_last_logged_event_id = 0
+# the file an in-memory database is saved to, see `save_snapshot`
+_snapshot_path = None
+# the value of `total_changes` when the last snapshot was saved
+_snapshot_changes = 0
+# ``(time, counts)`` of the last `get_row_counts` call counting the rows
+_row_counts = (0, None)
+
+INSERT_SECONDS = metrics.Histogram(
+    'maildump_db_insert_seconds', 'Time spent writing a batch before committing it', labels=('operation',)
+)
+COMMIT_SECONDS = metrics.Histogram('maildump_db_commit_seconds', 'Time spent committing a batch', labels=('operation',))
+MESSAGE_SIZE = metrics.Histogram(
+    'maildump_message_size_bytes', 'Size of received messages', buckets=metrics.SIZE_BUCKETS
+)
+PART_SIZE = metrics.Histogram('maildump_part_size_bytes', 'Size of decoded message parts', buckets=metrics.SIZE_BUCKETS)
+
+
+def connect(
+    db=None,
+    synchronous=SYNCHRONOUS,
+    cache_size=CACHE_SIZE,
+    mmap_size=MMAP_SIZE,
+    readers=READERS,
+    part_storage=PART_STORAGE,
+    part_cache_size=PART_CACHE_SIZE,
+    compression=None,
+    snapshot=False,
+    read_only=False,
+):
+    """Connect to the database and upgrade its schema if needed.
+
+    File databases use WAL journaling, so the `readers` read-only
+    connections used by the web interface never have to wait for ingest
+    transactions to finish. An in-memory database only has a single
+    connection which is used for both reading and writing.
+
+    `cache_size` is in KiB, `mmap_size` in bytes.
+
+    With `part_storage` set to ``index``, part bodies are not stored but
+    decoded from the message source when requested, keeping up to
+    `part_cache_size` bytes of decoded bodies in memory. Switching an
+    existing database to ``index`` drops the part bodies stored before.
+
+    With `compression` set to the name of a codec (``zlib`` or ``zstd``),
+    new message sources and stored text parts are compressed. Data stored
+    before is not affected, use `recompress` for it.
+
+    Several processes may use the same file database at once, changes made
+    by the others are available through `get_remote_events`.
+
+    With `snapshot` set, the database is kept in memory and `db` is only
+    used for the snapshots written by `save_snapshot`; the last snapshot is
+    loaded when connecting.
+
+    With `read_only` set, nothing is ever written to the file database `db`,
+    so this process never waits for the write lock held by the process
+    receiving messages. That process also creates and upgrades the
+    database; connecting waits until it has done so.
+    """
+    global _conn, _readers, _part_cache, _instance_id, _snapshot_path, _snapshot_changes, _read_only
+    configure(part_storage, compression)
     db = db or ':memory:'
-    log.info(f'Using database {db}')
-    _conn = sqlite3.connect(db, detect_types=sqlite3.PARSE_DECLTYPES)
-    _conn.row_factory = sqlite3.Row
-    _conn.text_factory = str
+    _snapshot_path = db if snapshot and db != ':memory:' else None
+    in_memory = db == ':memory:' or _snapshot_path is not None
+    _read_only = read_only and not in_memory
+    pragmas = {'synchronous': synchronous, 'cache_size': -cache_size, 'mmap_size': mmap_size}
+    if _snapshot_path:
+        log.info(f'Using in-memory database with snapshots in {db}')
+        _conn = _connect(':memory:', pragmas)
+        _load_snapshot()
+    elif _read_only:
+        log.info(f'Using database {db} (read-only)')
+        _conn = _connect_read_only(db, pragmas)
+    else:
+        log.info(f'Using database {db}')
+        _conn = _connect(db, pragmas)
+    if not _read_only:
+        _conn.execute('PRAGMA busy_timeout = 5000')
+        if not in_memory:
+            _enable_auto_vacuum()
+            _conn.execute('PRAGMA journal_mode = WAL')
+        migrations.upgrade(_conn)
+    _instance_id = _conn.execute("SELECT value FROM meta WHERE key = 'instance_id'").fetchone()[0]
+    _init_event_log(not in_memory)
+    # changes made while connecting (e.g. migrations) are saved by the next snapshot
+    _snapshot_changes = 0
+    _part_cache = LRUCache(part_cache_size)
+    if part_storage == 'index':
+        # stored parts are converted by the process receiving messages
+        if not _read_only:
+            _index_stored_parts()
+    else:
+        stats = get_blob_stats()
+        if stats['blobs']:
+            log.info(
+                'Blob store: {blobs} bodies for {refs} parts, {saved_bytes} bytes saved '
+                '(dedup ratio {dedup_ratio:.2f})'.format(**stats)
+            )
+    if in_memory:
+        return
+    uri = f'file:{pathname2url(db)}?mode=ro'
+    _readers = Queue()
+    for __ in range(readers):
+        _readers.put(_connect(uri, pragmas, uri=True))
+
+
+def _load_snapshot():
+    if not os.path.exists(_snapshot_path):
+        log.info('No snapshot found, starting with an empty database')
+        return
+    start = time.monotonic()
+    source = sqlite3.connect(_snapshot_path)
+    try:
+        # integrates and removes the WAL in case the file has been used as a
+        # regular database before, so a stale WAL never ends up next to a
+        # snapshot written later
+        source.execute('PRAGMA journal_mode = DELETE')
+        source.backup(_conn)
+    finally:
+        source.close()
+    log.info(f'Loaded snapshot in {time.monotonic() - start:.2f}s')
+
+
+def save_snapshot():
+    """Save the in-memory database to its snapshot file.
+
+    The snapshot is written to a temporary file which then replaces the
+    previous snapshot, so there is always a complete snapshot on disk.
+    Other greenlets keep running (and may even write to the database)
+    while the snapshot is being written. Nothing is written if there
+    have been no changes since the last snapshot.
+
+    Returns whether a snapshot has been written.
+    """
+    global _snapshot_changes
+    if _snapshot_path is None or _conn.total_changes == _snapshot_changes:
+        return False
+    changes = _conn.total_changes
+    start = time.monotonic()
+    tmp_path = _snapshot_path + '.tmp'
+    with suppress(FileNotFoundError):
+        os.unlink(tmp_path)
+    target = sqlite3.connect(tmp_path)
+    try:
+        _conn.backup(target, pages=SNAPSHOT_STEP_PAGES, progress=lambda *args: gevent.sleep(0))
+        target.close()
+        os.replace(tmp_path, _snapshot_path)
+    except BaseException:
+        target.close()
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+    _snapshot_changes = changes
+    log.debug(f'Saved snapshot in {time.monotonic() - start:.2f}s')
+    return True
+
+
+def configure(part_storage=PART_STORAGE, compression=None):
+    """Set how message data is stored without connecting to the database.
+
+    This is done by `connect`; processes which only prepare messages using
+    `extract_message_parts` need to call it on their own.
+    """
+    global _part_storage, _codec
+    _codec = get_codec(compression) if compression else None
+    _part_storage = part_storage
+
+
+def get_instance_id():
+    """Get the unique id of the database.
+
+    Message ids are never reused within a database, so together with the
+    instance id they identify a message even across restarts.
+    """
+    return _instance_id
+
+
+def _enable_auto_vacuum():
+    # Freed pages are returned to the file system by `incremental_vacuum`.
+    # On new databases this only needs to happen before the first table is
+    # created, existing ones need to be rebuilt once.
+    if _conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    _conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    if _conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        log.info('Enabling incremental vacuum, this may take a while')
+        _conn.execute('VACUUM')
+
+
+def _connect_read_only(db, pragmas):
+    uri = f'file:{pathname2url(db)}?mode=ro'
+    waiting = False
+    while True:
+        try:
+            conn = _connect(uri, pragmas, uri=True)
+        except sqlite3.OperationalError:
+            # the file does not exist yet
+            conn = None
+        if conn is not None:
+            if migrations.is_up_to_date(conn):
+                return conn
+            conn.close()
+        if not waiting:
+            log.info('Waiting for the database to be created or upgraded by the process receiving messages')
+            waiting = True
+        gevent.sleep(SCHEMA_POLL_INTERVAL)
+
+
+def is_read_only():
+    """Check whether this process must not write to the database."""
+    return _read_only
+
+
+def _connect(db, pragmas, **kwargs):
+    conn = sqlite3.connect(db, detect_types=sqlite3.PARSE_DECLTYPES, **kwargs)
+    conn.row_factory = sqlite3.Row
+    conn.text_factory = str
+    for name, value in pragmas.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+
+@contextmanager
+def _reader():
+    """Borrow a read-only connection from the pool."""
+    if _readers is None:
+        yield _conn
+        return
+    conn = _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
 
 
 def disconnect():
-    global _conn
+    global _conn, _readers
+    if _readers is not None:
+        while not _readers.empty():
+            _readers.get().close()
+        _readers = None
     if _conn:
         log.debug('Closing database')
         _conn.close()
         _conn = None
 
 
-def create_tables():
-    log.debug('Creating tables')
-    _conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS message (
-            id INTEGER PRIMARY KEY ASC,
-            sender TEXT,
-            recipients TEXT,
-            subject TEXT,
-            source BLOB,
-            size INTEGER,
-            type TEXT,
-            created_at TIMESTAMP
-        )
-        """,
-    )
+def extract_message_parts(body):
+    """Locate and decode all parts of a raw message.
 
-    _conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS message_part (
-            id INTEGER PRIMARY KEY ASC,
-            message_id INTEGER NOT NULL,
-            cid TEXT,
-            type TEXT,
-            is_attachment INTEGER,
-            filename TEXT,
-            charset TEXT,
-            body BLOB,
-            size INTEGER,
-            created_at TIMESTAMP
-        )
-        """,
-    )
+    This is the expensive part of storing a message. It does not touch the
+    database so it can run in a worker thread or process; the result is
+    stored using `add_message_parts`.
 
+    Returns the list of parts and, if compression is enabled, a
+    ``(codec, data)`` tuple containing the compressed message source.
+    """
+    body.seek(0)
+    data = body.read()
+    # parts are decoded without copying them out of the message first
+    view = memoryview(data)
+    parts = []
+    for headers, start, end in mime.iter_parts(data):
+        part = mime.get_part_info(headers)
+        part['offset'] = start
+        part['length'] = end - start
+        part['body'] = body = mime.decode_body(view[start:end], part['encoding'])
+        part['hash'] = _get_blob_hash(part, body)
+        part['text'] = None if part['is_attachment'] else mime.get_text(part['type'], part['charset'], body)
+        if _part_storage != 'index' and not part['hash']:
+            part['stored_body'] = compress(_codec, body)
+        parts.append(part)
+    source = compress(_codec, data) if _codec else None
+    if source and source[0] is None:
+        # not worth it
+        source = None
+    return parts, source
 
-def iter_message_parts(message):
-    if message.is_multipart():
-        for msg in message.get_payload():
-            yield from iter_message_parts(msg)
-    else:
-        yield message
+
+def _get_blob_hash(part, body):
+    # Attachments and inline parts such as logos are kept in the
+    # content-addressed blob store; text bodies are rarely identical,
+    # and in `index` mode no bodies are stored at all
+    if _part_storage == 'index' or not body or (not part['is_attachment'] and part['type'].startswith('text/')):
+        return None
+    return hashlib.sha256(body).hexdigest()
 
 
-def add_message(sender, recipients, body, message):
+def add_messages(messages):
+    """Store multiple messages in a single transaction.
+
+    `messages` is a list of ``(sender, recipients, body, headers)`` tuples
+    where `body` is a file-like object containing the raw message and
+    `headers` the parsed message headers. The message parts are not stored
+    yet; messages are flagged as having pending parts until their parts
+    have been stored using `add_message_parts`.
+
+    Messages that cannot be stored are skipped without affecting the rest
+    of the batch. The ``add_message`` events containing the lightweight
+    messages are only broadcast once the transaction has been committed.
+
+    Returns the list of new message ids (``None`` for failed messages).
+    """
+    message_ids = []
+    start = time.perf_counter()
+    _conn.execute('BEGIN')
+    try:
+        for sender, recipients, body, headers in messages:
+            _conn.execute('SAVEPOINT add_message')
+            try:
+                message_id = _insert_message(sender, recipients, body, headers)
+            except Exception:
+                log.exception(f'Could not store message from {sender}')
+                _conn.execute('ROLLBACK TO add_message')
+                message_id = None
+            _conn.execute('RELEASE add_message')
+            message_ids.append(message_id)
+        new_ids = [message_id for message_id in message_ids if message_id is not None]
+        sql = f'SELECT {_get_message_cols(True)} FROM message WHERE id IN ({",".join("?" * len(new_ids))})'  # noqa: S608
+        events = [('add_message', _message_from_row(row)) for row in _conn.execute(sql, new_ids)]
+        events = _log_events(events)
+        INSERT_SECONDS.labels('add_messages').observe(time.perf_counter() - start)
+        with COMMIT_SECONDS.labels('add_messages').time():
+            _conn.commit()
+    except BaseException:
+        _conn.rollback()
+        raise
+    _broadcast(events)
+    return message_ids
+
+
+def _insert_message(sender, recipients, body, headers):
     sql = """
         INSERT INTO message
-            (sender, recipients, subject, source, type, size, created_at)
+            (sender, recipients, subject, source, type, size, created_at, parts_ready)
         VALUES
-            (?, ?, ?, ?, ?, ?, datetime('now'))
+            (?, ?, ?, zeroblob(?), ?, ?, datetime('now'), 0)
     """
 
     to_list = [decode_header(r) for r in recipients]
-    cc_list = split_addresses(decode_header(message['CC'])) if 'CC' in message else []
-    bcc_list = split_addresses(decode_header(message['BCC'])) if 'BCC' in message else []
+    cc_list = split_addresses(decode_header(headers['CC'])) if 'CC' in headers else []
+    bcc_list = split_addresses(decode_header(headers['BCC'])) if 'BCC' in headers else []
     all_recipients = {'to': to_list, 'cc': cc_list, 'bcc': bcc_list}
+    size = body.seek(0, os.SEEK_END)
+    MESSAGE_SIZE.observe(size)
     cur = _conn.cursor()
     cur.execute(
         sql,
         (
             decode_header(sender),
             json.dumps(all_recipients),
-            decode_header(message['Subject']),
-            body,
-            message.get_content_type(),
-            len(body),
+            decode_header(headers['Subject']),
+            size,
+            headers.get_content_type(),
+            size,
         ),
     )
     message_id = cur.lastrowid
-    # Store parts (why do we do this for non-multipart at all?!)
-    parts = 0
-    for part in iter_message_parts(message):
-        cid = part.get('Content-Id') or str(uuid.uuid4())
-        if cid[0] == '<' and cid[-1] == '>':
-            cid = cid[1:-1]
-        _add_message_part(message_id, cid, part)
-        parts += 1
-    _conn.commit()
     cur.close()
-    log.debug(f'Stored message {message_id} (parts={parts})')
-    broadcast('add_message', message_id)
+    _conn.execute(
+        'INSERT INTO message_fts (rowid, sender, recipients, subject, body) VALUES (?, ?, ?, ?, ?)',
+        (
+            message_id,
+            decode_header(sender),
+            ' '.join(to_list + cc_list + bcc_list),
+            decode_header(headers['Subject']),
+            '',
+        ),
+    )
+    body.seek(0)
+    with _conn.blobopen('message', 'source', message_id) as blob:
+        while chunk := body.read(CHUNK_SIZE):
+            blob.write(chunk)
+    log.debug(f'Stored message {message_id}')
     return message_id
 
 
-def _add_message_part(message_id, cid, part):
+def add_message_parts(results):
+    """Store the parts of multiple messages in a single transaction.
+
+    `results` is a list of ``(message_id, parts, source)`` tuples where
+    `parts` and `source` are the values returned by `extract_message_parts`.
+    """
+    stored = []
+    start = time.perf_counter()
+    try:
+        for message_id, parts, source in results:
+            cur = _conn.execute(
+                """
+                UPDATE message SET
+                    parts_ready = 1, has_plain = ?, has_html = ?, attachment_count = ?, attachments = ?
+                WHERE
+                    id = ?
+                """,
+                (*_get_parts_summary(parts), message_id),
+            )
+            if not cur.rowcount:
+                # message has been deleted in the meantime
+                continue
+            if source:
+                # replace the source with its compressed version
+                codec, data = source
+                _conn.execute('UPDATE message SET source = ?, source_codec = ? WHERE id = ?', (data, codec, message_id))
+            for part in parts:
+                _add_message_part(message_id, part)
+            if text := '\n'.join(part['text'] for part in parts if part.get('text')):
+                _conn.execute('UPDATE message_fts SET body = ? WHERE rowid = ?', (text, message_id))
+            stored.append(message_id)
+            log.debug(f'Stored parts of message {message_id} (parts={len(parts)})')
+        events = [('update_message', message_id) for message_id in stored]
+        events = _log_events(events)
+        INSERT_SECONDS.labels('add_message_parts').observe(time.perf_counter() - start)
+        with COMMIT_SECONDS.labels('add_message_parts').time():
+            _conn.commit()
+    except BaseException:
+        _conn.rollback()
+        raise
+    _broadcast(events)
+
+
+def _get_parts_summary(parts):
+    # Stored with the message, so getting the message info does not need to
+    # look at its parts at all
+    types = {part['type'] for part in parts if not part['is_attachment']}
+    attachments = sorted(
+        (
+            {'cid': part['cid'], 'type': part['type'], 'filename': part['filename'], 'size': len(part['body'] or b'')}
+            for part in parts
+            if part['is_attachment']
+        ),
+        key=itemgetter('filename'),
+    )
+    return (
+        'text/plain' in types,
+        bool(types & {'text/html', 'application/xhtml+xml'}),
+        len(attachments),
+        json.dumps(attachments),
+    )
+
+
+def _add_message_part(message_id, part):
     sql = """
         INSERT INTO message_part
-            (message_id, cid, type, is_attachment, filename, charset, body, size, created_at)
+            (message_id, cid, type, is_attachment, filename, charset, body, size, body_offset, body_length, encoding,
+             blob_hash, body_codec, created_at)
         VALUES
-            (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
     """
 
-    body = part.get_payload(decode=True)
+    body = part['body']
     body_len = len(body) if body else 0
+    PART_SIZE.observe(body_len)
+    blob_hash = None
+    body_codec, body = part.get('stored_body', (None, body))
+    # Store part bodies (why do we do this for non-multipart at all?!)
+    if _part_storage == 'index':
+        # the body is decoded from the message source when needed
+        body = None
+    elif part['hash']:
+        # attachments and inline parts are often sent many times
+        _conn.execute(
+            """
+            INSERT INTO blob (hash, body, size, refcount) VALUES (?, ?, ?, 1)
+            ON CONFLICT (hash) DO UPDATE SET refcount = refcount + 1
+            """,
+            (part['hash'], part['body'], body_len),
+        )
+        blob_hash = part['hash']
+        body = None
     _conn.execute(
         sql,
         (
             message_id,
-            cid,
-            part.get_content_type(),
-            part.get_filename() is not None,
-            part.get_filename(),
-            part.get_content_charset(),
+            part['cid'],
+            part['type'],
+            part['is_attachment'],
+            part['filename'],
+            part['charset'],
             body,
             body_len,
+            part['offset'],
+            part['length'],
+            part['encoding'],
+            blob_hash,
+            body_codec,
         ),
     )
 
 
-def _get_message_cols(lightweight):
-    cols = ('sender', 'recipients', 'created_at', 'subject', 'id', 'size') if lightweight else ('*',)
+def _load_part_body(conn, part):
+    """Convert a part row to a dict containing the decoded part body.
+
+    Depending on the part storage mode the body is either stored in the
+    part row, in the blob store or needs to be decoded from the message
+    source.
+    """
+    if part is None:
+        return None
+    part = dict(part)
+    if part['blob_hash'] is not None:
+        part['body'] = conn.execute('SELECT body FROM blob WHERE hash = ?', (part['blob_hash'],)).fetchone()[0]
+        return part
+    if part['body'] is not None:
+        part['body'] = decompress(part['body_codec'], part['body'])
+        return part
+    if part['body_offset'] is None:
+        return part
+    key = (part['message_id'], part['id'])
+    body = _part_cache.get(key)
+    if body is None:
+        data = _read_source(conn, part['message_id'], part['body_offset'], part['body_length'])
+        body = mime.decode_body(data, part['encoding'])
+        _part_cache.set(key, body)
+    part['body'] = body
+    return part
+
+
+def _read_source(conn, message_id, offset, length):
+    # A single statement, since the source is replaced once it has been
+    # compressed; compressed sources can only be decompressed as a whole
+    sql = 'SELECT source_codec, IIF(source_codec IS NULL, substr(source, ?, ?), source) FROM message WHERE id = ?'
+    codec, data = conn.execute(sql, (offset + 1, length, message_id)).fetchone()
+    if codec is not None:
+        return decompress(codec, data)[offset : offset + length]
+    return data
+
+
+def _open_part_body(conn, part):
+    """Convert a part row to a dict containing the part body as a file.
+
+    Bodies which do not need to be decoded are read from the database
+    while the file is being read; the row must not contain the body but
+    whether it has been stored in the part row (`has_body`).
+    """
+    if part is None:
+        return None
+    part = dict(part)
+    has_body = part.pop('has_body')
+    source_codec = part.pop('source_codec')
+    source_length = part.pop('source_length')
+    if part['blob_hash'] is not None:
+        rowid = conn.execute('SELECT rowid FROM blob WHERE hash = ?', (part['blob_hash'],)).fetchone()[0]
+        part['body'] = _open_blob('blob', 'body', rowid, 0, part['size'], part['size'])
+    elif has_body and part['body_codec'] is not None:
+        body = conn.execute('SELECT body FROM message_part WHERE id = ?', (part['id'],)).fetchone()[0]
+        part['body'] = BytesIO(decompress(part['body_codec'], body))
+    elif has_body:
+        part['body'] = _open_blob('message_part', 'body', part['id'], 0, part['size'], part['size'])
+    elif part['body_offset'] is not None and part['encoding'] in IDENTITY_ENCODINGS and source_codec is None:
+        part['body'] = _open_blob(
+            'message', 'source', part['message_id'], part['body_offset'], part['body_length'], source_length
+        )
+    else:
+        part['body'] = BytesIO(_load_part_body(conn, dict(part, body=None))['body'] or b'')
+    return part
+
+
+def _open_blob(table, column, rowid, offset, length, size):
+    return BufferedReader(_BlobReader(table, column, rowid, offset, length, size), CHUNK_SIZE)
+
+
+class _BlobReader(RawIOBase):
+    """Read a range of a blob in the database.
+
+    Neither a connection nor the blob are kept open between reads, so
+    slow consumers do not block others from using the reader pool. A
+    message source is replaced by its compressed version once its parts
+    have been stored, so the blob must still have the `size` it had when
+    the reader was created; otherwise reading fails instead of returning
+    a mix of both versions.
+    """
+
+    def __init__(self, table, column, rowid, offset, length, size):
+        self._table = table
+        self._column = column
+        self._rowid = rowid
+        self._offset = offset
+        self._length = length
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self._length
+        self._pos = max(0, pos)
+        return self._pos
+
+    def readinto(self, buf):
+        size = min(len(buf), self._length - self._pos)
+        if size <= 0:
+            return 0
+        with _reader() as conn:
+            try:
+                with conn.blobopen(self._table, self._column, self._rowid, readonly=True) as blob:
+                    if len(blob) != self._size:
+                        raise OSError(f'{self._table} {self._rowid} has changed while reading it')
+                    blob.seek(self._offset + self._pos)
+                    data = blob.read(size)
+            except sqlite3.OperationalError as exc:
+                raise OSError(f'Could not read {self._table} {self._rowid}: {exc}') from exc
+        buf[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+class _IterReader(RawIOBase):
+    """Read the chunks returned by an iterator."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buf = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self._buf:
+            self._buf = next(self._chunks, None)
+            if self._buf is None:
+                self._buf = b''
+                return 0
+        size = min(len(buf), len(self._buf))
+        buf[:size] = self._buf[:size]
+        self._buf = self._buf[size:]
+        return size
+
+
+def _index_stored_parts():
+    """Drop stored part bodies which can be decoded from the message source.
+
+    This converts parts stored in ``copy`` mode to ``index`` mode. Bodies are
+    only dropped if decoding them from the source yields the same data.
+    """
+    message_ids = [
+        row[0]
+        for row in _conn.execute(
+            'SELECT DISTINCT message_id FROM message_part WHERE body IS NOT NULL OR blob_hash IS NOT NULL'
+        )
+    ]
+    if not message_ids:
+        return
+    log.info(f'Converting parts of {len(message_ids)} messages to index storage')
+    sql = """
+        SELECT
+            message_part.id, message_part.body, message_part.body_codec, message_part.blob_hash,
+            blob.body AS blob_body
+        FROM
+            message_part
+        LEFT JOIN
+            blob ON (blob.hash = message_part.blob_hash)
+        WHERE
+            message_part.message_id = ?
+        ORDER BY
+            message_part.id
+    """
+    for message_id in message_ids:
+        row = _conn.execute('SELECT source, source_codec FROM message WHERE id = ?', (message_id,)).fetchone()
+        if row is None:
+            continue
+        source = decompress(row['source_codec'], row['source'])
+        located = list(mime.iter_parts(source))
+        rows = _conn.execute(sql, (message_id,)).fetchall()
+        if len(rows) != len(located):
+            log.warning(f'Keeping stored parts of message {message_id}; the source does not match')
+            continue
+        updates = []
+        for row, (headers, start, end) in zip(rows, located, strict=True):
+            encoding = mime.get_part_info(headers)['encoding']
+            body = row['blob_body'] if row['blob_hash'] is not None else decompress(row['body_codec'], row['body'])
+            if mime.decode_body(source[start:end], encoding) != (body or b''):
+                log.warning(f'Keeping stored parts of message {message_id}; the source does not match')
+                break
+            updates.append((start, end - start, encoding, row['id']))
+        else:
+            _release_blobs(message_id)
+            _conn.executemany(
+                """
+                UPDATE message_part SET
+                    body = NULL, body_codec = NULL, blob_hash = NULL, body_offset = ?, body_length = ?, encoding = ?
+                WHERE
+                    id = ?
+                """,
+                updates,
+            )
+            _conn.commit()
+
+
+def _get_message_cols(lightweight, info=False):
+    if not lightweight:
+        return '*'
+    cols = ('sender', 'recipients', 'created_at', 'subject', 'id', 'size', 'parts_ready')
+    if info:
+        cols += ('has_plain', 'has_html', 'attachment_count', 'attachments')
     return ','.join(cols)
 
 
@@ -150,35 +781,51 @@ def _parse_recipients(recipients):
         return recipients
 
 
-def get_message(message_id, lightweight=False):
-    cols = _get_message_cols(lightweight)
-    row = _conn.execute(f'SELECT {cols} FROM message WHERE id = ?', (message_id,)).fetchone()  # noqa: S608
-    if not row:
-        return None
+def _message_from_row(row):
     row = dict(row)
     row['recipients'] = _parse_recipients(row['recipients'])
+    row['parts_ready'] = bool(row['parts_ready'])
+    if 'source' in row:
+        row['source'] = decompress(row.pop('source_codec'), row['source'])
+    if 'attachments' in row:
+        row['has_plain'] = bool(row['has_plain'])
+        row['has_html'] = bool(row['has_html'])
+        row['attachments'] = [
+            dict(attachment, message_id=row['id']) for attachment in json.loads(row['attachments'] or '[]')
+        ]
     return row
 
 
-def get_message_attachments(message_id):
-    sql = """
-        SELECT
-            message_id, cid, type, filename, size
-        FROM
-            message_part
-        WHERE
-            message_id = ? AND
-            is_attachment = 1
-        ORDER BY
-            filename ASC
+def get_message(message_id, lightweight=False, info=False):
+    """Get a message.
+
+    With `info` set, lightweight messages also contain the summary of
+    their parts (`has_plain`, `has_html` and the `attachments`).
     """
-    return _conn.execute(sql, (message_id,)).fetchall()
+    cols = _get_message_cols(lightweight, info)
+    with _reader() as conn:
+        row = conn.execute(f'SELECT {cols} FROM message WHERE id = ?', (message_id,)).fetchone()  # noqa: S608
+    if not row:
+        return None
+    return _message_from_row(row)
 
 
-def _get_message_part_types(message_id, types):
+def get_messages_info(message_ids, lightweight=False):
+    """Get multiple messages including the summary of their parts.
+
+    Messages which do not exist are skipped.
+    """
+    cols = _get_message_cols(lightweight, True)
+    sql = f'SELECT {cols} FROM message WHERE id IN ({",".join("?" * len(message_ids))})'  # noqa: S608
+    with _reader() as conn:
+        rows = {row['id']: row for row in conn.execute(sql, message_ids)}
+    return [_message_from_row(rows[message_id]) for message_id in message_ids if message_id in rows]
+
+
+def _get_message_part_types(message_id, types, stream=False):
     sql = """
         SELECT
-            *
+            {}
         FROM
             message_part
         WHERE
@@ -188,69 +835,454 @@ def _get_message_part_types(message_id, types):
         LIMIT
             1
     """.format(
+        STREAM_PART_COLS if stream else '*',
         ','.join('?' * len(types)),
     )
-    return _conn.execute(sql, (message_id, *types)).fetchone()
+    with _reader() as conn:
+        part = conn.execute(sql, (message_id, *types)).fetchone()
+        return _open_part_body(conn, part) if stream else _load_part_body(conn, part)
 
 
 def get_message_part_html(message_id):
     return _get_message_part_types(message_id, ('text/html', 'application/xhtml+xml'))
 
 
-def get_message_part_plain(message_id):
-    return _get_message_part_types(message_id, ('text/plain',))
+def open_message_part_plain(message_id):
+    """Get the plain text part of a message with its body as a file."""
+    return _get_message_part_types(message_id, ('text/plain',), stream=True)
+
 
+def open_message_part(message_id, cid):
+    """Get a message part with its body as a file."""
+    with _reader() as conn:
+        part = conn.execute(
+            f'SELECT {STREAM_PART_COLS} FROM message_part WHERE message_id = ? AND cid = ?',  # noqa: S608
+            (message_id, cid),
+        ).fetchone()
+        return _open_part_body(conn, part)
 
-def get_message_part_cid(message_id, cid):
-    return _conn.execute('SELECT * FROM message_part WHERE message_id = ? AND cid = ?', (message_id, cid)).fetchone()
 
+def open_message_source(message_id, content_encodings=()):
+    """Get the source of a message as a file.
 
-def _message_has_types(message_id, types):
+    Returns the file, its size and its content encoding. Compressed
+    sources are only sent as they are stored if their codec has one of
+    the `content_encodings`, otherwise they are decompressed while reading.
+    """
+    sql = 'SELECT length(source) AS length, size, source_codec FROM message WHERE id = ?'
+    with _reader() as conn:
+        row = conn.execute(sql, (message_id,)).fetchone()
+    if not row:
+        return None, None, None
+    source = _open_blob('message', 'source', message_id, 0, row['length'] or 0, row['length'] or 0)
+    if row['source_codec'] is None:
+        return source, row['length'] or 0, None
+    codec = get_codec(row['source_codec'])
+    if codec.content_encoding in content_encodings:
+        return source, row['length'], codec.content_encoding
+    chunks = iter(partial(source.read, CHUNK_SIZE), b'')
+    return BufferedReader(_IterReader(codec.iter_decompress(chunks)), CHUNK_SIZE), row['size'], None
+
+
+def get_blob_stats():
+    """Get statistics about the deduplicated part bodies."""
     sql = """
         SELECT
-            1
+            COUNT(*) AS blobs,
+            COALESCE(SUM(refcount), 0) AS refs,
+            COALESCE(SUM(size), 0) AS stored_bytes,
+            COALESCE(SUM(size * refcount), 0) AS referenced_bytes
         FROM
-            message_part
+            blob
+    """
+    with _reader() as conn:
+        stats = dict(conn.execute(sql).fetchone())
+    stats['saved_bytes'] = stats['referenced_bytes'] - stats['stored_bytes']
+    stats['dedup_ratio'] = stats['referenced_bytes'] / stats['stored_bytes'] if stats['stored_bytes'] else 1.0
+    return stats
+
+
+def get_database_size():
+    """Get the size of the database in bytes."""
+    with _reader() as conn:
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    return page_count * page_size
+
+
+def get_row_counts(max_age=ROW_COUNTS_MAX_AGE):
+    """Get the number of rows in the main tables.
+
+    Counting scans the tables, so the counts are reused for `max_age`
+    seconds.
+    """
+    global _row_counts
+    counted_at, counts = _row_counts
+    if counts is None or time.monotonic() - counted_at > max_age:
+        with _reader() as conn:
+            counts = {
+                table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]  # noqa: S608
+                for table in ('message', 'message_part', 'blob')
+            }
+        _row_counts = (time.monotonic(), counts)
+    return counts
+
+
+metrics.Gauge('maildump_db_size_bytes', 'Size of the database', get_database_size)
+metrics.Gauge(
+    'maildump_db_rows',
+    'Number of rows in the database tables',
+    lambda: {(table,): count for table, count in get_row_counts().items()},
+    labels=('table',),
+)
+
+
+def get_messages(lightweight=False, before=None, limit=None):
+    """Get messages, oldest first.
+
+    If `before` or `limit` is set, up to `limit` messages with an id lower
+    than `before` are returned instead, newest first.
+    """
+    if before is None and limit is None:
+        return list(iter_messages(lightweight))
+    cols = _get_message_cols(lightweight)
+    where = 'WHERE id < ?' if before is not None else ''
+    params = (before, limit) if before is not None else (limit,)
+    with _reader() as conn:
+        rows = conn.execute(f'SELECT {cols} FROM message {where} ORDER BY id DESC LIMIT ?', params).fetchall()  # noqa: S608
+    return list(map(_message_from_row, rows))
+
+
+def iter_messages(lightweight=False, chunk_size=500):
+    """Iterate over all messages, oldest first.
+
+    Messages are loaded `chunk_size` at a time and no database connection
+    is held in between, so consumers may take as long as they want.
+    """
+    cols = _get_message_cols(lightweight)
+    sql = f'SELECT {cols} FROM message WHERE id > ? ORDER BY id ASC LIMIT ?'  # noqa: S608
+    last_id = 0
+    while True:
+        with _reader() as conn:
+            rows = conn.execute(sql, (last_id, chunk_size)).fetchall()
+        yield from map(_message_from_row, rows)
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1]['id']
+
+
+def find_message(since=0, sender=None, recipient=None, subject=None, subject_contains=None):
+    """Find the oldest message newer than `since` matching all given criteria.
+
+    `sender` and `recipient` are matched case-insensitively against the
+    envelope addresses, `subject` exactly and `subject_contains` as a
+    case-insensitive substring. Only messages whose parts have been stored
+    are considered. Message bodies are never searched.
+
+    The message is returned including the summary of its parts, or
+    ``None`` if there is no matching message.
+    """
+    criteria = ['id > ?', 'parts_ready = 1']
+    params = [since]
+    if sender is not None:
+        criteria.append('sender = ? COLLATE NOCASE')
+        params.append(sender)
+    if recipient is not None:
+        criteria.append("EXISTS (SELECT 1 FROM json_each(recipients, '$.to') WHERE value = ? COLLATE NOCASE)")
+        params.append(recipient)
+    if subject is not None:
+        criteria.append('subject = ?')
+        params.append(subject)
+    if subject_contains is not None:
+        criteria.append('instr(lower(subject), lower(?)) > 0')
+        params.append(subject_contains)
+    cols = _get_message_cols(True, info=True)
+    sql = f'SELECT {cols} FROM message WHERE {" AND ".join(criteria)} ORDER BY id ASC LIMIT 1'  # noqa: S608
+    with _reader() as conn:
+        row = conn.execute(sql, params).fetchone()
+    return _message_from_row(row) if row else None
+
+
+def _get_search_query(query):
+    # Every word is matched as a prefix, so searching works while typing
+    # and user input never results in an FTS5 syntax error
+    terms = ('"{}"*'.format(term.replace('"', '""')) for term in query.split())
+    return ' '.join(terms)
+
+
+def search_messages(query, limit=50, offset=0):
+    """Search messages using the full-text index.
+
+    The sender, recipients, subject and the text of the message body are
+    searched; matches in the subject and sender are ranked higher. Returns
+    a list of lightweight messages, the best match first.
+    """
+    match = _get_search_query(query)
+    if not match:
+        return []
+    cols = ', '.join(f'message.{col}' for col in _get_message_cols(True).split(','))
+    sql = f"""
+        SELECT
+            {cols}
+        FROM
+            message_fts
+        JOIN
+            message ON (message.id = message_fts.rowid)
         WHERE
-            message_id = ? AND
-            is_attachment = 0 AND
-            type IN ({})
+            message_fts MATCH ?
+        ORDER BY
+            bm25(message_fts, 4.0, 2.0, 8.0, 1.0) ASC,
+            message.id DESC
         LIMIT
-            1
-    """.format(
-        ','.join('?' * len(types)),
-    )
-    res = _conn.execute(sql, (message_id, *types)).fetchone()
-    return res is not None
+            ? OFFSET ?
+    """  # noqa: S608
+    with _reader() as conn:
+        rows = conn.execute(sql, (match, limit, offset)).fetchall()
+    return list(map(_message_from_row, rows))
 
 
-def message_has_html(message_id):
-    return _message_has_types(message_id, ('application/xhtml+xml', 'text/html'))
+def recompress(compression=None, batch_size=100):
+    """Recompress all stored message sources and text parts.
 
+    Data is stored using the codec named `compression`, or uncompressed if
+    it is ``None``. Messages are processed in batches of `batch_size`, each
+    in its own transaction. Returns the number of stored bytes before and
+    after.
+    """
+    codec = get_codec(compression) if compression else None
+    before = after = 0
+    last_id = 0
+    sql = 'SELECT id, body, body_codec FROM message_part WHERE message_id = ? AND body IS NOT NULL'
+    while rows := _conn.execute(
+        'SELECT id, source, source_codec FROM message WHERE id > ? ORDER BY id LIMIT ?', (last_id, batch_size)
+    ).fetchall():
+        try:
+            for row in rows:
+                before, after = _recompress_value(codec, 'message', 'source', row, before, after)
+                for part_row in _conn.execute(sql, (row['id'],)).fetchall():
+                    before, after = _recompress_value(codec, 'message_part', 'body', part_row, before, after)
+            _conn.commit()
+        except BaseException:
+            _conn.rollback()
+            raise
+        last_id = rows[-1]['id']
+        log.debug(f'Recompressed messages up to {last_id}')
+    return before, after
 
-def message_has_plain(message_id):
-    return _message_has_types(message_id, ('text/plain',))
 
+def _recompress_value(codec, table, column, row, before, after):
+    stored_codec, stored = row[f'{column}_codec'], row[column] or b''
+    new_codec, data = compress(codec, decompress(stored_codec, stored))
+    if new_codec != stored_codec:
+        _conn.execute(
+            f'UPDATE {table} SET {column} = ?, {column}_codec = ? WHERE id = ?',  # noqa: S608
+            (data, new_codec, row['id']),
+        )
+    else:
+        data = stored
+    return before + len(stored), after + len(data)
 
-def get_messages(lightweight=False):
-    cols = _get_message_cols(lightweight)
-    rows = list(map(dict, _conn.execute(f'SELECT {cols} FROM message ORDER BY created_at ASC').fetchall()))  # noqa: S608
-    for row in rows:
-        row['recipients'] = _parse_recipients(row['recipients'])
-    return rows
 
+def vacuum():
+    """Rebuild the database file to return all unused space."""
+    _conn.execute('VACUUM')
 
-def delete_message(message_id):
+
+def register_cache(cache):
+    """Register a cache of data derived from messages.
+
+    The keys of the `LRUCache` must be tuples starting with the message id;
+    cached entries are discarded when their message is deleted.
+    """
+    _caches.append(cache)
+
+
+def _discard_cached(message_ids=None):
+    for cache in (_part_cache, *_caches):
+        if message_ids is None:
+            cache.clear()
+        else:
+            cache.discard_where(lambda key: key[0] in message_ids)
+
+
+def _release_blobs(message_id):
+    sql = """
+        SELECT
+            blob_hash, COUNT(*)
+        FROM
+            message_part
+        WHERE
+            message_id = ? AND
+            blob_hash IS NOT NULL
+        GROUP BY
+            blob_hash
+    """
+    refs = [(count, blob_hash) for blob_hash, count in _conn.execute(sql, (message_id,))]
+    _conn.executemany('UPDATE blob SET refcount = refcount - ? WHERE hash = ?', refs)
+    _conn.executemany('DELETE FROM blob WHERE hash = ? AND refcount <= 0', [(blob_hash,) for __, blob_hash in refs])
+
+
+def _delete_message(message_id):
     _conn.execute('DELETE FROM message WHERE id = ?', (message_id,))
+    _release_blobs(message_id)
     _conn.execute('DELETE FROM message_part WHERE message_id = ?', (message_id,))
+    _conn.execute('DELETE FROM message_fts WHERE rowid = ?', (message_id,))
+
+
+def delete_message(message_id):
+    _delete_message(message_id)
+    events = [('delete_message', message_id)]
+    events = _log_events(events)
     _conn.commit()
+    _discard_cached({message_id})
     log.debug(f'Deleted message {message_id}')
-    broadcast('delete_message', message_id)
+    _broadcast(events)
+
+
+def _get_expired_message_ids(max_messages, max_bytes, max_age, limit):
+    ids = set()
+    if max_age:
+        sql = """
+            SELECT
+                id
+            FROM
+                message
+            WHERE
+                created_at < datetime('now', ?)
+            ORDER BY
+                created_at ASC
+            LIMIT
+                ?
+        """
+        ids.update(row[0] for row in _conn.execute(sql, (f'-{max_age} seconds', limit)))
+    if max_messages is not None:
+        excess = _conn.execute('SELECT COUNT(*) FROM message').fetchone()[0] - max_messages
+        if excess > 0:
+            sql = 'SELECT id FROM message ORDER BY created_at ASC, id ASC LIMIT ?'
+            ids.update(row[0] for row in _conn.execute(sql, (min(excess, limit),)))
+    if max_bytes is not None:
+        excess = _conn.execute('SELECT COALESCE(SUM(size), 0) FROM message').fetchone()[0] - max_bytes
+        if excess > 0:
+            sql = 'SELECT id, size FROM message ORDER BY created_at ASC, id ASC LIMIT ?'
+            for message_id, size in _conn.execute(sql, (limit,)).fetchall():
+                if excess <= 0:
+                    break
+                ids.add(message_id)
+                excess -= size
+    return sorted(ids)[:limit]
+
+
+def evict_messages(max_messages=None, max_bytes=None, max_age=None, limit=100):
+    """Delete the oldest messages exceeding the retention limits.
+
+    At most `limit` messages are deleted in a single transaction, so the
+    writer is never blocked for long; the number of deleted messages is
+    returned. `max_bytes` refers to the size of the message sources and
+    `max_age` is in seconds.
+    """
+    try:
+        message_ids = _get_expired_message_ids(max_messages, max_bytes, max_age, limit)
+        for message_id in message_ids:
+            _delete_message(message_id)
+        events = [('delete_message', message_id) for message_id in message_ids]
+        events = _log_events(events)
+        _conn.commit()
+    except BaseException:
+        _conn.rollback()
+        raise
+    if message_ids:
+        _discard_cached(set(message_ids))
+        log.debug(f'Evicted {len(message_ids)} messages')
+    _broadcast(events)
+    return len(message_ids)
+
+
+def incremental_vacuum(pages):
+    """Return up to `pages` free pages to the file system."""
+    if _conn.execute('PRAGMA freelist_count').fetchone()[0]:
+        # `execute` only frees a single page, the pragma needs to be stepped until done
+        _conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
 
 
 def delete_messages():
     _conn.execute('DELETE FROM message')
     _conn.execute('DELETE FROM message_part')
+    _conn.execute('DELETE FROM blob')
+    _conn.execute('DELETE FROM message_fts')
+    events = [('delete_messages', None)]
+    events = _log_events(events)
     _conn.commit()
+    _discard_cached()
     log.debug('Deleted all messages')
-    broadcast('delete_messages')
+    _broadcast(events)
+
+
+def _init_event_log(enabled):
+    global _event_log, _origin, _data_version, _last_logged_event_id
+    _event_log = enabled
+    if not enabled:
+        return
+    _origin = uuid.uuid4().hex
+    _data_version = _conn.execute('PRAGMA data_version').fetchone()[0]
+    _last_logged_event_id = _conn.execute('SELECT COALESCE(MAX(id), 0) FROM event').fetchone()[0]
+    # all processes sharing the database use the same event ids
+    use_event_log(_instance_id, _last_logged_event_id)
+
+
+def _log_events(events):
+    """Log ``(name, data)`` events for other processes sharing the database.
+
+    Returns a list of ``(name, data, event_id)`` tuples, where `event_id` is
+    ``None`` if there is no event log.
+    """
+    # Called in the transaction making the changes, so other processes
+    # see the events together with the changes
+    if not _event_log or not events:
+        return [(name, data, None) for name, data in events]
+    _conn.executemany(
+        'INSERT INTO event (origin, name, data) VALUES (?, ?, ?)',
+        [(_origin, name, json_dumps(data).decode() if data is not None else None) for name, data in events],
+    )
+    # we hold the write lock, so the events got consecutive ids
+    last_id = _conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+    _conn.execute('DELETE FROM event WHERE id <= ? - ?', (last_id, EVENT_LOG_SIZE))
+    first_id = last_id - len(events) + 1
+    return [(name, data, first_id + i) for i, (name, data) in enumerate(events)]
+
+
+def _broadcast(events):
+    for name, data, event_id in events:
+        broadcast(name, data, event_id)
+
+
+def get_remote_events():
+    """Get the events of other processes sharing the database.
+
+    Only events logged since the previous call are returned, as a list of
+    ``(name, data, event_id)`` tuples. Checking for changes is cheap, so this can be
+    polled frequently. Cached data of messages deleted by other processes
+    is discarded.
+    """
+    global _data_version, _last_logged_event_id
+    if not _event_log:
+        return []
+    # only changes committed by other connections change the data version
+    data_version = _conn.execute('PRAGMA data_version').fetchone()[0]
+    if data_version == _data_version:
+        return []
+    _data_version = data_version
+    rows = _conn.execute(
+        'SELECT id, origin, name, data FROM event WHERE id > ? ORDER BY id', (_last_logged_event_id,)
+    ).fetchall()
+    events = []
+    for row in rows:
+        _last_logged_event_id = row['id']
+        if row['origin'] == _origin:
+            continue
+        data = json.loads(row['data']) if row['data'] is not None else None
+        if row['name'] == 'delete_message':
+            _discard_cached({data})
+        elif row['name'] == 'delete_messages':
+            _discard_cached()
+        events.append((row['name'], data, row['id']))
+    return events
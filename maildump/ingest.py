@@ -0,0 +1,180 @@
+import time
+from functools import partial
+
+import gevent
+from gevent.queue import Empty, Queue
+from gevent.threadpool import ThreadPool
+from logbook import Logger
+
+from maildump import db, metrics
+
+log = Logger(__name__)
+
+QUEUE_SIZE = 1000
+BATCH_SIZE = 100
+MAX_DELAY = 0.05
+PARSE_WORKERS = 2
+
+_queue = None
+_writer = None
+_pool = None
+_queue_size = QUEUE_SIZE
+# messages which have been accepted but whose parts have not been stored yet
+_in_flight = 0
+
+PARSE_SECONDS = metrics.Histogram('maildump_ingest_parse_seconds', 'Time spent decoding the MIME parts of a message')
+BATCH_SIZE_HISTOGRAM = metrics.Histogram(
+    'maildump_ingest_batch_size',
+    'Number of items written in a single batch',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+metrics.Gauge('maildump_ingest_in_flight', 'Messages whose parts have not been stored yet', lambda: _in_flight)
+
+
+def start(queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, max_delay=MAX_DELAY, parse_workers=PARSE_WORKERS):
+    """Start the writer greenlet storing queued messages in the database.
+
+    Messages are committed in batches of up to `batch_size` messages; a
+    batch is written at most `max_delay` seconds after its first message
+    has been queued. Unless an SMTP worker process has already done so,
+    decoding the MIME parts of a message happens in a pool of
+    `parse_workers` threads once the message itself has been stored.
+    """
+    global _queue, _writer, _pool, _queue_size
+    log.debug(f'Starting ingest writer (queue={queue_size}, batch={batch_size}, delay={max_delay}s)')
+    _queue_size = queue_size
+    _queue = Queue()
+    _pool = ThreadPool(parse_workers)
+    _writer = gevent.spawn(_run, _queue, batch_size, max_delay)
+
+
+def stop():
+    """Store all pending messages and stop the writer greenlet."""
+    global _queue, _writer, _pool
+    if _writer is None:
+        return
+    log.debug(f'Stopping ingest writer ({_in_flight} pending)')
+    _queue.put(StopIteration)
+    _writer.join()
+    _pool.kill()
+    _queue = _writer = _pool = None
+
+
+def enqueue_message(sender, recipients, body, headers, extracted=None):
+    """Queue a message to be stored in the database.
+
+    The queue takes ownership of the `body` file. If the parts of the
+    message have already been extracted elsewhere, `extracted` is an object
+    whose `load` method returns the result of `db.extract_message_parts`
+    and the time it took, and whose `close` method is called once the
+    message has been stored; the queue takes ownership of it as well.
+    Returns ``False`` without queueing the message if too many messages are
+    still being processed.
+    """
+    global _in_flight
+    if _in_flight >= _queue_size:
+        return False
+    _in_flight += 1
+    _queue.put(_Message(sender, recipients, body, headers, extracted))
+    return True
+
+
+class _Message:
+    def __init__(self, sender, recipients, body, headers, extracted):
+        self.sender = sender
+        self.recipients = recipients
+        self.body = body
+        self.headers = headers
+        self.extracted = extracted
+
+
+class _Parts:
+    def __init__(self, message_id, message, load):
+        self.message_id = message_id
+        self.message = message
+        # returns the extracted parts and the time it took, or raises
+        self.load = load
+
+
+def _run(queue, batch_size, max_delay):
+    stopping = False
+    while not stopping or _in_flight:
+        item = queue.get()
+        if item is StopIteration:
+            stopping = True
+            continue
+        batch = [item]
+        deadline = time.monotonic() + max_delay
+        while len(batch) < batch_size:
+            try:
+                item = queue.get(timeout=max(0, deadline - time.monotonic()))
+            except Empty:
+                break
+            if item is StopIteration:
+                stopping = True
+                continue
+            batch.append(item)
+        BATCH_SIZE_HISTOGRAM.observe(len(batch))
+        _store_messages([x for x in batch if isinstance(x, _Message)])
+        _store_parts([x for x in batch if isinstance(x, _Parts)])
+
+
+def _store_messages(messages):
+    if not messages:
+        return
+    try:
+        message_ids = db.add_messages([(m.sender, m.recipients, m.body, m.headers) for m in messages])
+    except Exception:
+        log.exception(f'Could not store {len(messages)} messages')
+        message_ids = [None] * len(messages)
+    for message, message_id in zip(messages, message_ids, strict=True):
+        if message_id is None:
+            _done(message)
+        elif message.extracted is not None:
+            _queue.put(_Parts(message_id, message, message.extracted.load))
+        else:
+            result = _pool.spawn(_extract_parts, message.body)
+            result.rawlink(partial(_queue_parts, message_id, message))
+    log.debug(f'Stored batch of {len(messages)} messages')
+
+
+def _extract_parts(body):
+    # Runs in the thread pool; the duration is recorded by the writer
+    # greenlet since metrics are not thread-safe
+    start = time.perf_counter()
+    result = db.extract_message_parts(body)
+    return result, time.perf_counter() - start
+
+
+def _queue_parts(message_id, message, result):
+    _queue.put(_Parts(message_id, message, result.get))
+
+
+def _store_parts(items):
+    if not items:
+        return
+    results = []
+    for item in items:
+        try:
+            (parts, source), duration = item.load()
+        except Exception as exc:
+            log.error(f'Could not extract parts of message {item.message_id}: {exc}')
+            results.append((item.message_id, [], None))
+        else:
+            PARSE_SECONDS.observe(duration)
+            results.append((item.message_id, parts, source))
+    try:
+        db.add_message_parts(results)
+    except Exception:
+        log.exception(f'Could not store parts of {len(items)} messages')
+    finally:
+        for item in items:
+            _done(item.message)
+
+
+def _done(message):
+    global _in_flight
+    message.body.close()
+    if message.extracted is not None:
+        message.extracted.close()
+    _in_flight -= 1
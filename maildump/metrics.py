@@ -0,0 +1,190 @@
+"""Metrics in the Prometheus text exposition format.
+
+Counters and histograms are plain Python objects updated in place, so
+recording a value only costs a few attribute lookups. Gauges are
+calculated by a function whenever the metrics are rendered.
+
+Metrics are collected per process; with SMTP workers, the SMTP metrics
+of the workers are not available.
+"""
+
+import time
+from bisect import bisect_left
+
+from logbook import Logger
+
+log = Logger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(1024 * 4**i for i in range(9))  # 1 KiB to 64 MiB
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = []
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._children = {}
+        self._default = None if labels else self.labels()
+        _registry.append(self)
+
+    def labels(self, *values):
+        """Get the child metric with the given label values."""
+        try:
+            return self._children[values]
+        except KeyError:
+            child = self._children[values] = self._new_child()
+            return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _render_samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._render_samples())
+        return lines
+
+    def _labels(self, values, extra=None):
+        pairs = list(zip(self.label_names, values, strict=True))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def _render_samples(self):
+        for values, child in list(self._children.items()):
+            yield f'{self.name}{self._labels(values)} {_format(child.value)}'
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'count', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is for values greater than the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """Observe the time spent in a ``with`` block."""
+        return _Timer(self)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        super().__init__(name, help, labels)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        """Observe the time spent in a ``with`` block."""
+        return _Timer(self._default)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts, strict=False):
+                cumulative += count
+                yield f'{self.name}_bucket{self._labels(values, ("le", _format(bound)))} {cumulative}'
+            yield f'{self.name}_bucket{self._labels(values, ("le", "+Inf"))} {child.count}'
+            yield f'{self.name}_sum{self._labels(values)} {_format(child.sum)}'
+            yield f'{self.name}_count{self._labels(values)} {child.count}'
+
+
+class Gauge(_Metric):
+    """A value calculated by `func` when the metrics are rendered.
+
+    With `labels`, `func` returns a dict mapping tuples of label values to
+    the values.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, func, labels=()):
+        self._func = func
+        super().__init__(name, help, labels)
+
+    def _new_child(self):
+        return None
+
+    def _render_samples(self):
+        value = self._func()
+        items = value.items() if self.label_names else [((), value)]
+        for values, item in items:
+            yield f'{self.name}{self._labels(values)} {_format(item)}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else str(int(value))
+    return str(value)
+
+
+def render():
+    """Render all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            log.exception(f'Could not collect metric {metric.name}')
+    return '\n'.join(lines) + '\n'
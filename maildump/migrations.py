@@ -0,0 +1,344 @@
+"""Database schema migrations.
+
+Every migration is a function receiving the database connection. They
+are applied in the order in which they are defined, and the number of
+applied migrations is stored in the `schema_version` table. Never change
+or remove a migration once it has been released; add a new one instead.
+
+Databases created before versioning was introduced start at version 0,
+so the first migrations must also work on such databases.
+"""
+
+import hashlib
+import html
+import json
+import quopri
+import re
+import sqlite3
+import uuid
+from email._encoded_words import decode_b
+from email.message import _decode_uu
+
+from logbook import Logger
+
+log = Logger(__name__)
+MIGRATIONS = []
+# used by `_get_text`
+RE_HTML_SKIP = re.compile(r'<(script|style|head)\b.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+RE_HTML_TAG = re.compile(r'<[^>]*>')
+RE_WHITESPACE = re.compile(r'\s+')
+
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+def _get_version(conn):
+    row = conn.execute('SELECT version FROM schema_version').fetchone()
+    return row[0] if row else 0
+
+
+def upgrade(conn):
+    """Apply all pending migrations.
+
+    Every migration reads the schema version in the same write transaction
+    it is applied in, so several processes starting on the same database at
+    once never apply a migration twice.
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    conn.commit()
+    initial_version = version = _get_version(conn)
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f'Database schema version {version} is newer than this version of MailDump')
+    while version < len(MIGRATIONS):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = _get_version(conn)
+            if version < len(MIGRATIONS):
+                func = MIGRATIONS[version]
+                version += 1
+                log.debug(f'Applying migration {version}: {func.__name__}')
+                func(conn)
+                conn.execute('DELETE FROM schema_version')
+                conn.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    if initial_version < len(MIGRATIONS):
+        log.info(f'Upgraded database schema from version {initial_version} to {len(MIGRATIONS)}')
+
+
+def is_up_to_date(conn):
+    """Check whether all migrations have been applied, without applying any."""
+    try:
+        version = _get_version(conn)
+    except sqlite3.OperationalError:
+        # the database has not been created yet
+        return False
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f'Database schema version {version} is newer than this version of MailDump')
+    return version == len(MIGRATIONS)
+
+
+def _get_columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+@migration
+def create_tables(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message (
+            id INTEGER PRIMARY KEY ASC,
+            sender TEXT,
+            recipients TEXT,
+            subject TEXT,
+            source BLOB,
+            size INTEGER,
+            type TEXT,
+            created_at TIMESTAMP
+        )
+        """,
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message_part (
+            id INTEGER PRIMARY KEY ASC,
+            message_id INTEGER NOT NULL,
+            cid TEXT,
+            type TEXT,
+            is_attachment INTEGER,
+            filename TEXT,
+            charset TEXT,
+            body BLOB,
+            size INTEGER,
+            created_at TIMESTAMP
+        )
+        """,
+    )
+
+
+@migration
+def add_parts_ready(conn):
+    if 'parts_ready' in _get_columns(conn, 'message'):
+        # Storing parts in the background started before schema versioning,
+        # and back then the column was added when connecting
+        return
+    # Existing messages have all their parts stored already
+    conn.execute('ALTER TABLE message ADD COLUMN parts_ready INTEGER NOT NULL DEFAULT 1')
+
+
+@migration
+def add_indexes(conn):
+    conn.execute('CREATE INDEX ix_message_created_at ON message (created_at)')
+    conn.execute('CREATE INDEX ix_message_part_message_id_cid ON message_part (message_id, cid)')
+    conn.execute(
+        'CREATE INDEX ix_message_part_message_id_is_attachment_type ON message_part (message_id, is_attachment, type)'
+    )
+
+
+@migration
+def add_part_index(conn):
+    conn.execute('ALTER TABLE message_part ADD COLUMN body_offset INTEGER')
+    conn.execute('ALTER TABLE message_part ADD COLUMN body_length INTEGER')
+    conn.execute('ALTER TABLE message_part ADD COLUMN encoding TEXT')
+
+
+@migration
+def add_blob_store(conn):
+    conn.execute(
+        """
+        CREATE TABLE blob (
+            hash TEXT PRIMARY KEY,
+            body BLOB,
+            size INTEGER,
+            refcount INTEGER NOT NULL
+        )
+        """,
+    )
+    conn.execute('ALTER TABLE message_part ADD COLUMN blob_hash TEXT')
+    # Move already stored attachment and inline part bodies to the blob store
+    sql = """
+        SELECT
+            id, body
+        FROM
+            message_part
+        WHERE
+            body IS NOT NULL AND
+            length(body) > 0 AND
+            (is_attachment OR type NOT LIKE 'text/%')
+    """
+    for part_id, body in conn.execute(sql).fetchall():
+        blob_hash = hashlib.sha256(body).hexdigest()
+        conn.execute(
+            """
+            INSERT INTO blob (hash, body, size, refcount) VALUES (?, ?, ?, 1)
+            ON CONFLICT (hash) DO UPDATE SET refcount = refcount + 1
+            """,
+            (blob_hash, body, len(body)),
+        )
+        conn.execute('UPDATE message_part SET body = NULL, blob_hash = ? WHERE id = ?', (blob_hash, part_id))
+
+
+# Copies of `mime.decode_body` and `mime.get_text` as they were when the
+# search index was added, so the migration always indexes the same text
+def _decode_body(data, encoding):
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    elif encoding == 'base64':
+        return decode_b(b''.join(data.splitlines()))[0]
+    elif encoding in {'x-uuencode', 'uuencode', 'uue', 'x-uue'}:
+        try:
+            return _decode_uu(data)
+        except ValueError:
+            return bytes(data)
+    return bytes(data)
+
+
+def _get_text(part_type, charset, body):
+    if part_type not in {'text/plain', 'text/html', 'application/xhtml+xml'} or not body:
+        return None
+    try:
+        text = body.decode(charset or 'utf-8', 'replace')
+    except LookupError:
+        text = body.decode('utf-8', 'replace')
+    if part_type != 'text/plain':
+        text = html.unescape(RE_HTML_TAG.sub(' ', RE_HTML_SKIP.sub(' ', text)))
+    return RE_WHITESPACE.sub(' ', text).strip() or None
+
+
+@migration
+def add_search_index(conn):
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE message_fts USING fts5 (
+            sender,
+            recipients,
+            subject,
+            body,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        """,
+    )
+    # Index existing messages; part bodies may only be available in the source
+    sql = """
+        SELECT
+            message_part.type, message_part.charset, message_part.body, message_part.encoding,
+            substr(message.source, message_part.body_offset + 1, message_part.body_length) AS data
+        FROM
+            message_part
+        JOIN
+            message ON (message.id = message_part.message_id)
+        WHERE
+            message_part.message_id = ? AND
+            message_part.is_attachment = 0
+    """
+    for message_id, sender, recipients, subject in conn.execute(
+        'SELECT id, sender, recipients, subject FROM message'
+    ).fetchall():
+        texts = []
+        for part_type, charset, body, encoding, data in conn.execute(sql, (message_id,)):
+            if body is None and data is not None:
+                body = _decode_body(data, encoding)
+            if text := _get_text(part_type, charset, body):
+                texts.append(text)
+        recipients = json.loads(recipients)
+        if isinstance(recipients, list):
+            # old messages only have a list of envelope recipients
+            recipient_list = recipients
+        else:
+            recipient_list = recipients['to'] + recipients['cc'] + recipients['bcc']
+        conn.execute(
+            'INSERT INTO message_fts (rowid, sender, recipients, subject, body) VALUES (?, ?, ?, ?, ?)',
+            (message_id, sender, ' '.join(recipient_list), subject, '\n'.join(texts)),
+        )
+
+
+@migration
+def add_message_summary(conn):
+    conn.execute('ALTER TABLE message ADD COLUMN has_plain INTEGER NOT NULL DEFAULT 0')
+    conn.execute('ALTER TABLE message ADD COLUMN has_html INTEGER NOT NULL DEFAULT 0')
+    conn.execute('ALTER TABLE message ADD COLUMN attachment_count INTEGER NOT NULL DEFAULT 0')
+    conn.execute('ALTER TABLE message ADD COLUMN attachments TEXT')
+    conn.execute(
+        """
+        UPDATE message SET
+            has_plain = EXISTS (
+                SELECT 1 FROM message_part
+                WHERE message_id = message.id AND is_attachment = 0 AND type = 'text/plain'
+            ),
+            has_html = EXISTS (
+                SELECT 1 FROM message_part
+                WHERE message_id = message.id AND is_attachment = 0 AND type IN ('text/html', 'application/xhtml+xml')
+            ),
+            attachment_count = (
+                SELECT COUNT(*) FROM message_part
+                WHERE message_id = message.id AND is_attachment = 1
+            ),
+            attachments = (
+                SELECT json_group_array(json_object('cid', cid, 'type', type, 'filename', filename, 'size', size))
+                FROM (
+                    SELECT cid, type, filename, size FROM message_part
+                    WHERE message_id = message.id AND is_attachment = 1
+                    ORDER BY filename ASC
+                )
+            )
+        """
+    )
+
+
+@migration
+def add_instance_id(conn):
+    # Identifies the database, e.g. to know whether a cached message still
+    # belongs to the same message id
+    conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+    conn.execute("INSERT INTO meta (key, value) VALUES ('instance_id', ?)", (uuid.uuid4().hex,))
+    # Never reuse the ids of deleted messages
+    conn.execute(
+        """
+        CREATE TABLE message_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT,
+            recipients TEXT,
+            subject TEXT,
+            source BLOB,
+            size INTEGER,
+            type TEXT,
+            created_at TIMESTAMP,
+            parts_ready INTEGER NOT NULL DEFAULT 1,
+            has_plain INTEGER NOT NULL DEFAULT 0,
+            has_html INTEGER NOT NULL DEFAULT 0,
+            attachment_count INTEGER NOT NULL DEFAULT 0,
+            attachments TEXT
+        )
+        """,
+    )
+    cols = 'id, sender, recipients, subject, source, size, type, created_at, parts_ready, has_plain, has_html, '
+    cols += 'attachment_count, attachments'
+    conn.execute(f'INSERT INTO message_new ({cols}) SELECT {cols} FROM message')  # noqa: S608
+    conn.execute('DROP TABLE message')
+    conn.execute('ALTER TABLE message_new RENAME TO message')
+    conn.execute('CREATE INDEX ix_message_created_at ON message (created_at)')
+
+
+@migration
+def add_codecs(conn):
+    conn.execute('ALTER TABLE message ADD COLUMN source_codec TEXT')
+    conn.execute('ALTER TABLE message_part ADD COLUMN body_codec TEXT')
+
+
+@migration
+def add_event_log(conn):
+    # Lets processes sharing the database notify each other of changes
+    conn.execute(
+        """
+        CREATE TABLE event (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            name TEXT NOT NULL,
+            data TEXT
+        )
+        """,
+    )
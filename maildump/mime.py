@@ -0,0 +1,168 @@
+"""Locate and decode the parts of a raw message.
+
+Unlike the `email` package this works on byte offsets in the raw source,
+so a part can be decoded later on from the stored source alone.
+"""
+
+import base64
+import binascii
+import html
+import quopri
+import re
+import uuid
+from email._encoded_words import decode_b
+from email.message import _decode_uu
+from email.parser import BytesHeaderParser
+from io import BytesIO
+
+RE_BLANK_LINE = re.compile(rb'\n\r?\n')
+RE_HTML_SKIP = re.compile(r'<(script|style|head)\b.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+RE_HTML_TAG = re.compile(r'<[^>]*>')
+# Size of the chunks of base64 data decoded at once
+BASE64_CHUNK_SIZE = 65536
+
+
+def iter_parts(data, start=0, end=None):
+    """Yield all leaf parts of a MIME entity.
+
+    Every part is returned as a ``(headers, body_start, body_end)`` tuple
+    where `headers` is an `email.message.Message` containing only the
+    headers of the part. Like the `email` package, attached messages are
+    treated as multipart entities.
+    """
+    if end is None:
+        end = len(data)
+    headers, body_start = _parse_headers(data, start, end)
+    boundary = headers.get_boundary() if headers.get_content_maintype() == 'multipart' else None
+    if boundary:
+        for part_start, part_end in _split_multipart(data, body_start, end, boundary.encode('ascii', 'replace')):
+            yield from iter_parts(data, part_start, part_end)
+    elif headers.get_content_type() == 'message/rfc822':
+        yield from iter_parts(data, body_start, end)
+    else:
+        yield headers, body_start, end
+
+
+def _parse_headers(data, start, end):
+    if data[start : start + 1] == b'\n':
+        header_end, body_start = start, start + 1
+    elif data[start : start + 2] == b'\r\n':
+        header_end, body_start = start, start + 2
+    elif m := RE_BLANK_LINE.search(data, start, end):
+        header_end, body_start = m.start() + 1, m.end()
+    else:
+        header_end = body_start = end
+    return BytesHeaderParser().parsebytes(data[start:header_end]), body_start
+
+
+def _split_multipart(data, start, end, boundary):
+    delimiter = b'--' + boundary
+    parts = []
+    part_start = None
+    pos = start
+    while (idx := data.find(delimiter, pos, end)) >= 0:
+        line_end = data.find(b'\n', idx, end)
+        line_end = end if line_end < 0 else line_end + 1
+        pos = line_end
+        rest = data[idx + len(delimiter) : line_end].rstrip()
+        if (idx > start and data[idx - 1 : idx] != b'\n') or rest not in {b'', b'--'}:
+            # not a delimiter line, e.g. the boundary in the middle of a line
+            pos = idx + len(delimiter)
+            continue
+        if part_start is not None:
+            # the line break preceding the delimiter belongs to it
+            part_end = idx - 1 if data[idx - 2 : idx] != b'\r\n' else idx - 2
+            parts.append((part_start, max(part_start, part_end)))
+        if rest == b'--':
+            return parts
+        part_start = line_end
+    if part_start is not None:
+        # missing close delimiter
+        parts.append((part_start, end))
+    return parts
+
+
+def get_part_info(headers):
+    """Get the metadata of a part based on its headers."""
+    cid = headers.get('Content-Id') or str(uuid.uuid4())
+    if cid[0] == '<' and cid[-1] == '>':
+        cid = cid[1:-1]
+    filename = headers.get_filename()
+    return {
+        'cid': cid,
+        'type': headers.get_content_type(),
+        'is_attachment': filename is not None,
+        'filename': filename,
+        'charset': headers.get_content_charset(),
+        'encoding': str(headers.get('Content-Transfer-Encoding', '')).strip().lower() or None,
+    }
+
+
+def decode_body(data, encoding):
+    """Decode a part body using its content transfer encoding.
+
+    This behaves like ``Message.get_payload(decode=True)``. `data` may be
+    a `memoryview`, e.g. of a part within the message source, which avoids
+    copying the encoded data.
+    """
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    elif encoding == 'base64':
+        return _decode_base64(data)
+    elif encoding in {'x-uuencode', 'uuencode', 'uue', 'x-uue'}:
+        data = bytes(data)
+        try:
+            return _decode_uu(data)
+        except ValueError:
+            return data
+    return bytes(data)
+
+
+def _decode_base64(data):
+    # Valid data is decoded chunk by chunk, so neither a copy without the
+    # line breaks nor the whole part is needed in memory at once. Anything
+    # else is left to the lenient decoder of the `email` package.
+    decoded = BytesIO()
+    rest = b''
+    padded = False
+    for pos in range(0, len(data), BASE64_CHUNK_SIZE):
+        chunk = rest + bytes(data[pos : pos + BASE64_CHUNK_SIZE]).translate(None, b'\r\n')
+        # only complete groups of four characters can be decoded on their own
+        split = len(chunk) - len(chunk) % 4
+        chunk, rest = chunk[:split], chunk[split:]
+        if not chunk:
+            continue
+        if padded:
+            # more data after the padding
+            break
+        try:
+            decoded.write(base64.b64decode(chunk, validate=True))
+        except binascii.Error:
+            break
+        padded = chunk.endswith(b'=')
+    else:
+        if not rest:
+            return decoded.getvalue()
+    return decode_b(b''.join(bytes(data).splitlines()))[0]
+
+
+def get_text(part_type, charset, body):
+    """Get the text of a decoded text part for the search index.
+
+    Markup is removed from HTML parts. Returns ``None`` for parts which
+    do not contain any text.
+    """
+    if part_type not in {'text/plain', 'text/html', 'application/xhtml+xml'} or not body:
+        return None
+    try:
+        text = body.decode(charset or 'utf-8', 'replace')
+    except LookupError:
+        text = body.decode('utf-8', 'replace')
+    if part_type != 'text/plain':
+        text = html.unescape(RE_HTML_TAG.sub(' ', RE_HTML_SKIP.sub(' ', text)))
+    # Whitespace is left as it is; the tokenizer of the search index ignores
+    # it anyway, and collapsing it needs several times the size of the text
+    # in memory for large parts
+    if not text or text.isspace():
+        return None
+    return text
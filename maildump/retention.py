@@ -0,0 +1,52 @@
+import gevent
+from logbook import Logger
+
+from maildump import db
+
+log = Logger(__name__)
+
+INTERVAL = 10
+BATCH_SIZE = 100
+VACUUM_PAGES = 1000
+
+_worker = None
+
+
+def start(max_messages=None, max_bytes=None, max_age=None, interval=INTERVAL, batch_size=BATCH_SIZE):
+    """Start the greenlet enforcing the retention limits.
+
+    Every `interval` seconds the oldest messages exceeding any of the
+    limits are deleted in batches of `batch_size` messages, yielding to
+    other greenlets between batches so ingest is not stalled. Nothing is
+    started if no limit is set.
+    """
+    global _worker
+    if max_messages is None and max_bytes is None and not max_age:
+        return
+    log.debug(f'Starting retention (messages={max_messages}, bytes={max_bytes}, age={max_age}s)')
+    _worker = gevent.spawn(_run, max_messages, max_bytes, max_age, interval, batch_size)
+
+
+def stop():
+    """Stop the retention greenlet."""
+    global _worker
+    if _worker is None:
+        return
+    _worker.kill()
+    _worker = None
+
+
+def _run(max_messages, max_bytes, max_age, interval, batch_size):
+    while True:
+        try:
+            evicted = db.evict_messages(max_messages, max_bytes, max_age, batch_size)
+            if evicted:
+                db.incremental_vacuum(VACUUM_PAGES)
+        except Exception:
+            log.exception('Could not enforce retention limits')
+            evicted = 0
+        if evicted == batch_size:
+            # more messages to evict, but let others use the database first
+            gevent.sleep(0)
+        else:
+            gevent.sleep(interval)
@@ -1,23 +1,474 @@
-from email.parser import BytesParser
+import os
+import socket
+from email._header_value_parser import get_addr_spec, get_angle_addr
+from email.errors import HeaderParseError
+from email.parser import BytesHeaderParser
+from tempfile import SpooledTemporaryFile
 
+from gevent.pool import Pool
+from gevent.server import StreamServer
 from logbook import Logger
 
-from maildump.db import add_message
-from maildump.vendor import smtpd
+from maildump import metrics
+from maildump.ingest import enqueue_message
 
 log = Logger(__name__)
 
+COMMAND_SIZE_LIMIT = 512
+DATA_SIZE_LIMIT = 33554432
+SPOOL_THRESHOLD = 1048576
 
-class SMTPServer(smtpd.SMTPServer):
-    def __init__(self, listener, handler):
-        super().__init__(listener, None)
+HANDLER_SECONDS = metrics.Histogram('maildump_smtp_handler_seconds', 'Time spent handing a received message over')
+MESSAGES = metrics.Counter('maildump_smtp_messages_total', 'Messages received via SMTP', labels=('result',))
+
+
+class SMTPServer(StreamServer):
+    """SMTP server running every session in its own greenlet.
+
+    `backlog` is passed to ``listen()`` and `max_connections` caps the
+    number of concurrent sessions; further connections wait in the
+    backlog until a session finishes. Message data larger than
+    `spool_threshold` bytes is spooled to a temporary file on disk.
+    """
+
+    def __init__(
+        self,
+        listener,
+        handler,
+        backlog=None,
+        max_connections=None,
+        data_size_limit=DATA_SIZE_LIMIT,
+        spool_threshold=SPOOL_THRESHOLD,
+    ):
+        spawn = Pool(max_connections) if max_connections else 'default'
+        super().__init__(listener, self._handle_connection, backlog=backlog, spawn=spawn)
         self._handler = handler
+        self.data_size_limit = data_size_limit
+        self.spool_threshold = spool_threshold
+        self.fqdn = socket.getfqdn()
+
+    def _handle_connection(self, sock, address):
+        SMTPSession(self, sock, address).run()
 
-    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        """Pass a received message to the handler.
+
+        The handler takes ownership of the `data` file and is responsible
+        for closing it. It returns ``None`` to accept the message or an
+        SMTP reply string to send instead.
+        """
         return self._handler(sender=mailfrom, recipients=rcpttos, body=data)
 
 
-def smtp_handler(sender, recipients, body):
-    message = BytesParser().parsebytes(body)
-    log.info("Received message from '{}' ({} bytes)".format(message['from'] or sender, len(body)))
-    add_message(sender, recipients, body, message)
+class SMTPSession:
+    """A single SMTP session.
+
+    Replies are buffered and only sent once we run out of input, so
+    pipelined commands (RFC 2920) are answered in a single write.
+    """
+
+    def __init__(self, server, sock, peer):
+        self.server = server
+        self.sock = sock
+        self.peer = peer
+        self.seen_greeting = ''
+        self.extended_smtp = False
+        self.quit = False
+        self._rbuf = bytearray()
+        self._wbuf = []
+        # set once the client closed its side of the connection
+        self._eof = False
+        # the message data received by BDAT commands so far
+        self._chunks = None
+        self._reset()
+
+    def _reset(self):
+        self.mailfrom = None
+        self.rcpttos = []
+        self.body_type = '7BIT'
+        if self._chunks is not None:
+            self._chunks.close()
+            self._chunks = None
+
+    def run(self):
+        log.debug(f'Incoming connection from {self.peer[0]}:{self.peer[1]}')
+        try:
+            self.push(f'220 {self.server.fqdn} MailDump')
+            while not self.quit:
+                line = self._read_line(COMMAND_SIZE_LIMIT)
+                if not line:
+                    break
+                self._handle_command(line)
+            self._flush()
+        except OSError as exc:
+            log.debug(f'Connection from {self.peer[0]}:{self.peer[1]} failed: {exc}')
+        finally:
+            self._reset()
+            self.sock.close()
+
+    def push(self, msg):
+        self._wbuf.append(msg.encode('utf-8') + b'\r\n')
+
+    def _flush(self):
+        if self._wbuf:
+            self.sock.sendall(b''.join(self._wbuf))
+            self._wbuf = []
+
+    def _read_line(self, limit):
+        """Read a line including its line break.
+
+        At most `limit` bytes are returned; if the line is longer, the
+        returned data does not end with a line break. An empty string
+        indicates that the client closed the connection; the last line may
+        also lack its line break in that case, which sets `_eof`.
+        """
+        start = 0
+        while True:
+            pos = self._rbuf.find(b'\n', start, limit)
+            if pos >= 0:
+                end = pos + 1
+                break
+            if len(self._rbuf) >= limit:
+                end = limit
+                break
+            start = len(self._rbuf)
+            # We only send our replies once we need to wait for more input
+            self._flush()
+            data = self.sock.recv(65536)
+            if not data:
+                self._eof = True
+                end = len(self._rbuf)
+                break
+            self._rbuf += data
+        line = bytes(self._rbuf[:end])
+        del self._rbuf[:end]
+        return line
+
+    def _skip_line(self):
+        while True:
+            line = self._read_line(COMMAND_SIZE_LIMIT)
+            if not line or line.endswith(b'\n'):
+                return
+
+    def _handle_command(self, line):
+        if not line.endswith(b'\n'):
+            self._skip_line()
+            self.push('500 Error: line too long')
+            return
+        line = line.rstrip(b'\r\n').decode('utf-8', 'replace')
+        if not line:
+            self.push('500 Error: bad syntax')
+            return
+        command, _, arg = line.partition(' ')
+        command = command.upper()
+        arg = arg.strip() or None
+        method = getattr(self, 'smtp_' + command, None)
+        if not method:
+            self.push(f'500 Error: command "{command}" not recognized')
+            return
+        method(arg)
+
+    def _getaddr(self, keyword, arg):
+        if not arg or arg[: len(keyword)].upper() != keyword:
+            return '', ''
+        arg = arg[len(keyword) :].strip()
+        if not arg:
+            return '', ''
+        try:
+            if arg.lstrip().startswith('<'):
+                address, rest = get_angle_addr(arg)
+            else:
+                address, rest = get_addr_spec(arg)
+        except HeaderParseError:
+            return '', ''
+        return address.addr_spec, rest.strip()
+
+    def smtp_HELO(self, arg):
+        if not arg:
+            self.push('501 Syntax: HELO hostname')
+            return
+        if self.seen_greeting:
+            self.push('503 Duplicate HELO/EHLO')
+            return
+        self._reset()
+        self.seen_greeting = arg
+        self.push(f'250 {self.server.fqdn}')
+
+    def smtp_EHLO(self, arg):
+        if not arg:
+            self.push('501 Syntax: EHLO hostname')
+            return
+        if self.seen_greeting:
+            self.push('503 Duplicate HELO/EHLO')
+            return
+        self._reset()
+        self.seen_greeting = arg
+        self.extended_smtp = True
+        self.push(f'250-{self.server.fqdn}')
+        if self.server.data_size_limit:
+            self.push(f'250-SIZE {self.server.data_size_limit}')
+        self.push('250-8BITMIME')
+        self.push('250-BINARYMIME')
+        self.push('250-CHUNKING')
+        self.push('250-PIPELINING')
+        self.push('250 HELP')
+
+    def smtp_NOOP(self, arg):
+        self.push('250 OK')
+
+    def smtp_QUIT(self, arg):
+        self.push('221 Bye')
+        self.quit = True
+
+    def smtp_RSET(self, arg):
+        if arg:
+            self.push('501 Syntax: RSET')
+            return
+        self._reset()
+        self.push('250 OK')
+
+    def smtp_HELP(self, arg):
+        self.push('250 Supported commands: EHLO HELO MAIL RCPT DATA BDAT RSET NOOP QUIT VRFY')
+
+    def smtp_VRFY(self, arg):
+        if not arg:
+            self.push('501 Syntax: VRFY <address>')
+            return
+        self.push('252 Cannot VRFY user, but will accept message and attempt delivery')
+
+    def smtp_EXPN(self, arg):
+        self.push('502 EXPN not implemented')
+
+    def smtp_MAIL(self, arg):
+        if not self.seen_greeting:
+            self.push('503 Error: send HELO first')
+            return
+        syntaxerr = '501 Syntax: MAIL FROM: <address>'
+        if self.extended_smtp:
+            syntaxerr += ' [SP <mail-parameters>]'
+        address, params = self._getaddr('FROM:', arg)
+        if not address or (params and not self.extended_smtp):
+            self.push(syntaxerr)
+            return
+        if self.mailfrom:
+            self.push('503 Error: nested MAIL command')
+            return
+        params = self._getparams(params)
+        if params is None:
+            self.push(syntaxerr)
+            return
+        body = params.pop('BODY', '7BIT')
+        if body not in {'7BIT', '8BITMIME', 'BINARYMIME'}:
+            self.push('501 Error: BODY can only be one of 7BIT, 8BITMIME, BINARYMIME')
+            return
+        size = params.pop('SIZE', None)
+        if size:
+            if not size.isdigit():
+                self.push(syntaxerr)
+                return
+            if self.server.data_size_limit and int(size) > self.server.data_size_limit:
+                self.push('552 Error: message size exceeds fixed maximum message size')
+                return
+        if params:
+            self.push('555 MAIL FROM parameters not recognized or not implemented')
+            return
+        self.mailfrom = address
+        self.body_type = body
+        self.push('250 OK')
+
+    def smtp_RCPT(self, arg):
+        if not self.seen_greeting:
+            self.push('503 Error: send HELO first')
+            return
+        if not self.mailfrom:
+            self.push('503 Error: need MAIL command')
+            return
+        syntaxerr = '501 Syntax: RCPT TO: <address>'
+        if self.extended_smtp:
+            syntaxerr += ' [SP <mail-parameters>]'
+        address, params = self._getaddr('TO:', arg)
+        if not address or (params and not self.extended_smtp):
+            self.push(syntaxerr)
+            return
+        if params:
+            self.push('555 RCPT TO parameters not recognized or not implemented')
+            return
+        self.rcpttos.append(address)
+        self.push('250 OK')
+
+    def smtp_DATA(self, arg):
+        if not self.seen_greeting:
+            self.push('503 Error: send HELO first')
+            return
+        if not self.rcpttos:
+            self.push('503 Error: need RCPT command')
+            return
+        if arg:
+            self.push('501 Syntax: DATA')
+            return
+        if self._chunks is not None:
+            self.push('503 Error: BDAT and DATA cannot be mixed')
+            return
+        if self.body_type == 'BINARYMIME':
+            self.push('503 Error: BODY=BINARYMIME requires BDAT')
+            return
+        self.push('354 End data with <CR><LF>.<CR><LF>')
+        data = self._read_data()
+        if data is None:
+            self.push('552 Error: Too much mail data')
+        else:
+            self._process_message(data)
+        self._reset()
+
+    def _read_data(self):
+        """Read the message data into a spool file.
+
+        The data is de-transparencied according to RFC 5321, Section 4.5.2
+        and line breaks are normalized to LF while reading, so the message
+        is never kept in memory as a whole unless it is smaller than the
+        spool threshold.
+        """
+        limit = self.server.data_size_limit
+        spool = SpooledTemporaryFile(max_size=self.server.spool_threshold)  # noqa: SIM115
+        bol = True
+        newline_pending = False
+        while True:
+            line = self._read_line(65536)
+            if not line or (self._eof and not line.endswith(b'\n')):
+                if spool is not None:
+                    spool.close()
+                raise ConnectionResetError('connection closed during DATA')
+            if bol and line in {b'.\r\n', b'.\n'}:
+                break
+            if bol and line[:1] == b'.':
+                line = line[1:]
+            bol = line.endswith(b'\n')
+            if spool is None:
+                continue
+            if bol:
+                line = line.removesuffix(b'\n').removesuffix(b'\r')
+            elif line.endswith(b'\r'):
+                # the LF may be in the next chunk
+                line = line[:-1]
+                self._rbuf[:0] = b'\r'
+            if newline_pending:
+                spool.write(b'\n')
+            spool.write(line)
+            # the final line break belongs to the terminator
+            newline_pending = bol
+            if limit and spool.tell() > limit:
+                spool.close()
+                spool = None
+        if spool is not None:
+            spool.seek(0)
+        return spool
+
+    def smtp_BDAT(self, arg):
+        """Receive a chunk of message data (RFC 3030).
+
+        The chunk is copied into the spool file as-is, without looking for
+        a terminator or undoing dot-stuffing. The data of a failed command
+        is still read, so the session stays in sync with the client.
+        """
+        args = arg.upper().split() if arg else []
+        if not 1 <= len(args) <= 2 or not args[0].isdigit() or args[1:] not in ([], ['LAST']):
+            self.push('501 Syntax: BDAT <size> [LAST]')
+            return
+        size = int(args[0])
+        last = len(args) == 2
+        limit = self.server.data_size_limit
+        received = self._chunks.tell() if self._chunks is not None else 0
+        if not self.seen_greeting:
+            error = '503 Error: send HELO first'
+        elif not self.rcpttos:
+            error = '503 Error: need RCPT command'
+        elif limit and received + size > limit:
+            error = '552 Error: Too much mail data'
+        else:
+            error = None
+        if error:
+            self._read_chunk(size, None)
+            self.push(error)
+            self._reset()
+            return
+        if self._chunks is None:
+            self._chunks = SpooledTemporaryFile(max_size=self.server.spool_threshold)  # noqa: SIM115
+        self._read_chunk(size, self._chunks)
+        if not last:
+            self.push(f'250 OK {size} octets received')
+            return
+        data = self._chunks
+        self._chunks = None
+        data.seek(0)
+        self._process_message(data)
+        self._reset()
+
+    def _read_chunk(self, size, spool):
+        """Copy exactly `size` bytes of input into `spool`.
+
+        The data is discarded if `spool` is ``None``.
+        """
+        while size:
+            if self._rbuf:
+                data = bytes(self._rbuf[:size])
+                del self._rbuf[:size]
+            else:
+                self._flush()
+                data = self.sock.recv(65536)
+                if not data:
+                    raise ConnectionResetError('connection closed during BDAT')
+                if len(data) > size:
+                    self._rbuf += data[size:]
+                    data = data[:size]
+            if spool is not None:
+                spool.write(data)
+            size -= len(data)
+
+    def _process_message(self, data):
+        try:
+            status = self.server.process_message(self.peer, self.mailfrom, self.rcpttos, data)
+        except Exception:
+            log.exception('Could not process message')
+            data.close()
+            status = '451 Requested action aborted: local error in processing'
+        self.push(status or '250 OK')
+
+    @staticmethod
+    def _getparams(params):
+        # Return params as dictionary. Return None if not all parameters
+        # appear to be syntactically valid according to RFC 1869.
+        result = {}
+        for param in params.upper().split():
+            param, eq, value = param.partition('=')
+            if not param.isalnum() or (eq and not value):
+                return None
+            result[param] = value if eq else True
+        return result
+
+
+def _parse_headers(body):
+    lines = []
+    for line in body:
+        if line in {b'\n', b'\r\n'}:
+            break
+        lines.append(line)
+    body.seek(0)
+    return BytesHeaderParser().parsebytes(b''.join(lines))
+
+
+def smtp_handler(sender, recipients, body, enqueue=enqueue_message):
+    # Only the headers are parsed here; decoding the MIME parts happens
+    # in the background once the message has been stored, or in the SMTP
+    # worker process that received it
+    with HANDLER_SECONDS.time():
+        headers = _parse_headers(body)
+        size = body.seek(0, os.SEEK_END)
+        body.seek(0)
+        accepted = enqueue(sender, recipients, body, headers)
+    if not accepted:
+        MESSAGES.labels('rejected').inc()
+        log.warning(f"Rejecting message from '{headers['from'] or sender}' ({size} bytes); ingest queue is full")
+        body.close()
+        return '451 Requested action aborted: server busy, try again later'
+    MESSAGES.labels('accepted').inc()
+    log.info("Received message from '{}' ({} bytes)".format(headers['from'] or sender, size))
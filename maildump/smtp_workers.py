@@ -0,0 +1,280 @@
+"""SMTP servers running in separate worker processes.
+
+Decoding received messages is CPU-bound, so a single process can only
+receive a limited number of messages per second. Worker processes share
+the SMTP port using ``SO_REUSEPORT``; each of them decodes, indexes and
+compresses the parts of the messages it receives and passes them to the
+main process, which only stores them in the database. A message is only
+acknowledged once the main process has queued it.
+
+A message is passed as a small pickled record containing its envelope,
+headers and the metadata of its parts, followed by the raw message and
+the data of the parts: their decoded bodies and text, and the compressed
+bodies and message source. The main process writes both straight into
+spool files and only reads the data of the parts when storing them.
+"""
+
+import os
+import pickle
+import signal
+import struct
+import time
+from functools import partial
+from tempfile import SpooledTemporaryFile
+
+import gevent
+import gevent.os
+from gevent import socket
+from gevent.event import Event
+from gevent.lock import Semaphore
+from logbook import Logger
+
+from maildump import db, ingest
+from maildump.smtp import SMTPServer, smtp_handler
+from maildump.util import reuse_port_listener
+
+log = Logger(__name__)
+
+BACKLOG = 128
+CHUNK_SIZE = 65536
+_HEADER = struct.Struct('!I')
+
+_workers = []
+
+
+class _Worker:
+    def __init__(self, pid, sock, receiver):
+        self.pid = pid
+        self.sock = sock
+        self.receiver = receiver
+
+
+def start(
+    count,
+    host,
+    port,
+    backlog=None,
+    max_connections=None,
+    spool_threshold=None,
+    part_storage=db.PART_STORAGE,
+    compression=None,
+):
+    """Fork `count` SMTP worker processes.
+
+    This must happen before the database is opened, so the workers never
+    share a database connection with the main process. `max_connections`
+    applies to each worker.
+    """
+    log.debug(f'Starting {count} SMTP workers')
+    workers = []
+    for __ in range(count):
+        parent_sock, child_sock = socket.socketpair()
+        pid = gevent.os.fork()
+        if not pid:
+            parent_sock.close()
+            for __, sock in workers:
+                sock.close()
+            # never return into the code of the main process
+            try:
+                _run_worker(
+                    child_sock, host, port, backlog, max_connections, spool_threshold, part_storage, compression
+                )
+            except BaseException:
+                log.exception('SMTP worker failed')
+                os._exit(1)
+            os._exit(0)
+        child_sock.close()
+        workers.append((pid, parent_sock))
+    # only spawned once all workers have been forked, as they would
+    # inherit the greenlets as well
+    for pid, sock in workers:
+        _workers.append(_Worker(pid, sock, gevent.spawn(_receive, sock, spool_threshold)))
+
+
+def stop():
+    """Stop the worker processes.
+
+    Messages the workers are still receiving are passed to the main
+    process before they exit.
+    """
+    if not _workers:
+        return
+    log.debug(f'Stopping {len(_workers)} SMTP workers')
+    for worker in _workers:
+        os.kill(worker.pid, signal.SIGTERM)
+    for worker in _workers:
+        worker.receiver.join()
+        worker.sock.close()
+        gevent.os.waitpid(worker.pid, 0)
+    _workers.clear()
+
+
+class _ExtractedParts:
+    """The parts of a message extracted by a worker process.
+
+    Their data stays in the spool `file` until the writer loads it to
+    store the parts, see `ingest.enqueue_message`.
+    """
+
+    def __init__(self, parts, source, duration, file):
+        self.parts = parts
+        self.source = source
+        self.duration = duration
+        self.file = file
+
+    def load(self):
+        self.file.seek(0)
+        return _attach_data(self.parts, self.source, self.file), self.duration
+
+    def close(self):
+        self.file.close()
+
+
+def _receive(sock, spool_threshold):
+    while (record := _recv(sock)) is not None:
+        sender, recipients, headers, size, parts, source, data_size, duration = record
+        body = SpooledTemporaryFile(max_size=spool_threshold)  # noqa: SIM115
+        data = SpooledTemporaryFile(max_size=spool_threshold)  # noqa: SIM115
+        extracted = _ExtractedParts(parts, source, duration, data)
+        if not _recv_into(sock, size, body) or not _recv_into(sock, data_size, extracted.file):
+            body.close()
+            extracted.close()
+            break
+        body.seek(0)
+        accepted = ingest.enqueue_message(sender, recipients, body, headers, extracted)
+        if not accepted:
+            body.close()
+            extracted.close()
+        sock.sendall(b'\1' if accepted else b'\0')
+
+
+def _run_worker(sock, host, port, backlog, max_connections, spool_threshold, part_storage, compression):
+    stop_event = Event()
+    # replace the signal handlers inherited from the main process
+    gevent.signal_handler(signal.SIGTERM, stop_event.set)
+    gevent.signal_handler(signal.SIGINT, stop_event.set)
+    db.configure(part_storage, compression)
+    lock = Semaphore()
+    server = SMTPServer(
+        reuse_port_listener(host, port, backlog or BACKLOG),
+        partial(smtp_handler, enqueue=partial(_enqueue, sock, lock, stop_event)),
+        max_connections=max_connections,
+        spool_threshold=spool_threshold,
+    )
+    server.start()
+    log.debug(f'SMTP worker {os.getpid()} started')
+    stop_event.wait()
+    server.stop()
+    sock.close()
+
+
+def _enqueue(sock, lock, stop_event, sender, recipients, body, headers):
+    # Decoding happens before taking the lock, so sessions only wait for
+    # each other while a message is being passed to the main process
+    with body:
+        start = time.perf_counter()
+        parts, source = db.extract_message_parts(body)
+        duration = time.perf_counter() - start
+        size = body.seek(0, os.SEEK_END)
+        parts, source, chunks = _detach_data(parts, source)
+        record = (sender, recipients, headers, size, parts, source, sum(map(len, chunks)), duration)
+        with lock:
+            try:
+                _send(sock, record)
+                body.seek(0)
+                while chunk := body.read(CHUNK_SIZE):
+                    sock.sendall(chunk)
+                for chunk in chunks:
+                    sock.sendall(chunk)
+                reply = sock.recv(1)
+            except OSError:
+                reply = None
+            if not reply:
+                log.error('Lost connection to the main process')
+                stop_event.set()
+                return False
+            return reply == b'\1'
+
+
+def _detach_data(parts, source):
+    """Replace the data of extracted parts with its size.
+
+    Returns the parts and the source to send in the record, and the chunks
+    of data to send after the message in the order `_attach_data` reads them.
+    """
+    chunks = []
+
+    def _detach(data):
+        if data is None:
+            return None
+        chunks.append(data)
+        return len(data)
+
+    for part in parts:
+        part['body'] = _detach(part['body'])
+        part['text'] = _detach(part['text'].encode('utf-8', 'surrogatepass') if part['text'] is not None else None)
+        codec, stored_body = part.pop('stored_body', (None, None))
+        if codec is not None:
+            # bodies which are not compressed are stored as they are
+            part['stored_body'] = codec, _detach(stored_body)
+    if source is not None:
+        source = source[0], _detach(source[1])
+    return parts, source, chunks
+
+
+def _attach_data(parts, source, file):
+    """Read the data of parts extracted by a worker from `file`.
+
+    Returns the parts and the source like `db.extract_message_parts`.
+    """
+
+    def _attach(size):
+        return None if size is None else file.read(size)
+
+    for part in parts:
+        part['body'] = _attach(part['body'])
+        text = _attach(part['text'])
+        part['text'] = text.decode('utf-8', 'surrogatepass') if text is not None else None
+        if 'stored_body' in part:
+            codec, size = part['stored_body']
+            part['stored_body'] = codec, _attach(size)
+    if source is not None:
+        source = source[0], _attach(source[1])
+    return parts, source
+
+
+def _send(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)))
+    sock.sendall(data)
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            return None
+        view = view[received:]
+    return buf
+
+
+def _recv_into(sock, size, file):
+    while size:
+        data = sock.recv(min(size, CHUNK_SIZE))
+        if not data:
+            return False
+        file.write(data)
+        size -= len(data)
+    return True
+
+
+def _recv(sock):
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)  # noqa: S301
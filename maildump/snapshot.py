@@ -0,0 +1,56 @@
+import gevent
+from gevent.event import Event
+from logbook import Logger
+
+from maildump import db
+
+log = Logger(__name__)
+
+INTERVAL = 60
+
+_worker = None
+_wakeup = None
+
+
+def start(interval=INTERVAL):
+    """Start the greenlet saving snapshots of the in-memory database.
+
+    A snapshot is saved every `interval` seconds if anything changed, and
+    whenever one is requested using `request`.
+    """
+    global _worker, _wakeup
+    log.debug(f'Starting snapshots (interval={interval}s)')
+    _wakeup = Event()
+    _worker = gevent.spawn(_run, _wakeup, interval)
+
+
+def request():
+    """Save a snapshot as soon as possible."""
+    if _wakeup is None:
+        log.warning('Snapshots are not enabled')
+        return
+    _wakeup.set()
+
+
+def stop():
+    """Stop the snapshot greenlet and save a final snapshot."""
+    global _worker, _wakeup
+    if _worker is None:
+        return
+    _worker.kill()
+    _worker = _wakeup = None
+    log.info('Saving snapshot')
+    try:
+        db.save_snapshot()
+    except Exception:
+        log.exception('Could not save snapshot')
+
+
+def _run(wakeup, interval):
+    while True:
+        wakeup.wait(interval)
+        wakeup.clear()
+        try:
+            db.save_snapshot()
+        except Exception:
+            log.exception('Could not save snapshot')
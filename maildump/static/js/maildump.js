@@ -13,10 +13,16 @@ import './message';
         evtSource = new EventSource('/event-stream');
         let wasConnected = false;
 
-        evtSource.onopen = () => {
+        // the server tells us whether we need to reload everything or whether
+        // it replays the events we missed since the last event we received
+        evtSource.addEventListener('connected', () => {
             wasConnected = true;
             states.connected();
-        };
+        });
+        evtSource.addEventListener('resumed', () => {
+            wasConnected = true;
+            states.resumed();
+        });
         evtSource.onerror = evt => {
             if (wasConnected) {
                 states.disconnected();
@@ -156,9 +162,14 @@ import './message';
 
         // Real-time updates
         waitForEvents({
-            add_message: id => {
-                console.log('SSE: received new message', id);
-                Message.load(+id, localStorage.getItem('notifications') === 'true');
+            add_message: data => {
+                const msg = JSON.parse(data);
+                console.log('SSE: received new message', msg.id);
+                Message.receive(msg, localStorage.getItem('notifications') === 'true');
+            },
+            update_message: id => {
+                console.log('SSE: updated message', id);
+                Message.update(+id);
             },
             delete_message: id => {
                 console.log('SSE: deleted message', id);
@@ -178,6 +189,11 @@ import './message';
                 document.body.classList.remove('disconnected');
                 Message.loadAll();
             },
+            resumed: () => {
+                console.log('SSE: resumed');
+                online = true;
+                document.body.classList.remove('disconnected');
+            },
             disconnected: () => {
                 console.log('SSE: disconnected');
                 if (terminating) {
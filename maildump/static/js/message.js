@@ -3,13 +3,9 @@
     var messages = {};
     var cleared = new Aborter();
     var filterTerm = '';
-
-    function addCacheBuster(formats) {
-        $.each(formats, function(format, url) {
-            formats[format] = url + '?_=' + (new Date().getTime());
-        });
-        return formats;
-    }
+    var SERVER_SEARCH_THRESHOLD = 500;
+    var searchSeq = 0;
+    var searchTimer = null;
 
     var Message = global.Message = function Message(msg, loadedEverything) {
         this._loaded = loadedEverything || false;
@@ -22,7 +18,7 @@
         this.size = msg.size;
         if(this._loaded) {
             this.href = msg.href;
-            this.formats = addCacheBuster(msg.formats);
+            this.formats = msg.formats;
             this.attachments = msg.attachments;
         }
         else {
@@ -138,7 +134,7 @@
                     self._loaded = true;
                     self.href = data.href;
                     self.attachments = data.attachments;
-                    self.formats = addCacheBuster(data.formats);
+                    self.formats = data.formats;
                     deferred.resolveWith(self);
                 });
             }
@@ -183,14 +179,30 @@
         });
     };
 
-    Message.load = function(id, notify) {
-        cleared.watch(restCall('GET', '/messages/' + id + '.json')).done(function(msg) {
-            var message = Message.add(msg, true);
-            Message.applyFilter();
-            if (notify) {
-                message.showNotification();
-            }
-        });
+    Message.receive = function(msg, notify) {
+        var message = Message.add(msg);
+        if (!message) {
+            return;
+        }
+        Message.applyFilter();
+        if (notify) {
+            message.showNotification();
+        }
+    };
+
+    Message.update = function(id) {
+        var message = Message.get(id);
+        if (!message || !message._loaded) {
+            return;
+        }
+        message._loaded = false;
+        if (message.selected()) {
+            message.load().done(function() {
+                if (this.selected()) {
+                    this.display();
+                }
+            });
+        }
     };
 
     Message.add = function(msg, loadedEverything) {
@@ -220,15 +232,51 @@
         if(term !== undefined) {
             filterTerm = term;
         }
-        var all = $('#messages > tr').show();
-        if (filterTerm) {
-            all.filter(function() {
-                return !$(this).text().toLowerCase().includes(filterTerm);
-            }).hide();
-            var selected = Message.getSelected();
-            if(selected && !selected.dom().is(':visible')) {
-                selected.deselect();
+        searchSeq++;
+        clearTimeout(searchTimer);
+        if (!filterTerm) {
+            $('#messages > tr').show();
+        }
+        else if (Object.keys(messages).length > SERVER_SEARCH_THRESHOLD) {
+            // Large mailboxes are searched on the server, which also searches the message bodies
+            var seq = searchSeq;
+            searchTimer = setTimeout(function() {
+                searchRemote(filterTerm, seq, 0, {});
+            }, 250);
+        }
+        else {
+            filterRows(function(row) {
+                return $(row).text().toLowerCase().includes(filterTerm);
+            });
+        }
+    };
+
+    function searchRemote(term, seq, offset, ids) {
+        var url = '/messages/?q=' + encodeURIComponent(term) + '&offset=' + offset;
+        cleared.watch(restCall('GET', url)).done(function(data) {
+            if (seq != searchSeq) {
+                return; // outdated
             }
+            $.each(data.messages, function(i, msg) {
+                ids[msg.id] = true;
+            });
+            if (data.messages.length == data.limit) {
+                searchRemote(term, seq, offset + data.limit, ids);
+                return;
+            }
+            filterRows(function(row) {
+                return $(row).data('messageId') in ids;
+            });
+        });
+    }
+
+    function filterRows(matches) {
+        $('#messages > tr').each(function() {
+            $(this).toggle(matches(this));
+        });
+        var selected = Message.getSelected();
+        if(selected && !selected.dom().is(':visible')) {
+            selected.deselect();
         }
     }
 })(jQuery, window);
@@ -0,0 +1,42 @@
+import gevent
+from logbook import Logger
+
+from maildump import db
+from maildump.web_realtime import broadcast
+
+log = Logger(__name__)
+
+POLL_INTERVAL = 0.1
+
+_worker = None
+
+
+def start(interval=POLL_INTERVAL):
+    """Start the greenlet forwarding events of other processes.
+
+    Every `interval` seconds the database is checked for changes made by
+    other processes sharing it, and their events are broadcast to the
+    clients of this process.
+    """
+    global _worker
+    log.debug(f'Starting event sync (interval={interval}s)')
+    _worker = gevent.spawn(_run, interval)
+
+
+def stop():
+    """Stop the event sync greenlet."""
+    global _worker
+    if _worker is None:
+        return
+    _worker.kill()
+    _worker = None
+
+
+def _run(interval):
+    while True:
+        try:
+            for event, data, event_id in db.get_remote_events():
+                broadcast(event, data, event_id)
+        except Exception:
+            log.exception('Could not get events of other processes')
+        gevent.sleep(interval)
@@ -1,28 +1,123 @@
 import json
+import zlib
+from collections import OrderedDict
 from datetime import datetime
 from email.header import decode_header as _decode_header
 from email.utils import getaddresses
 from functools import wraps
 
 import pkg_resources
-from flask import current_app
+from flask import current_app, request
+from gevent import socket
 from pytz import utc
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# JSON responses smaller than this are not compressed
+COMPRESS_MIN_SIZE = 1024
+
 
 def _json_default(obj):
     if isinstance(obj, datetime):
         return utc.localize(obj).isoformat()
+    elif isinstance(obj, bytes):
+        # message sources
+        return obj.decode('utf-8', 'replace')
     raise TypeError(repr(obj) + ' is not JSON serializable')
 
 
 def json_dumps(obj):
-    return json.dumps(obj, default=_json_default, indent=4)
+    """Serialize `obj` to compact JSON.
+
+    orjson is used if it is installed. Returns bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NAIVE_UTC)
+    return json.dumps(obj, default=_json_default, separators=(',', ':')).encode('utf-8')
 
 
 def jsonify(*args, **kwargs):
     return current_app.response_class(json_dumps(dict(*args, **kwargs)), mimetype='application/json')
 
 
+def jsonify_stream(key, items, buffer_size=65536):
+    """Stream a JSON object containing the list `items` as `key`.
+
+    The items are serialized one at a time, so the list never needs to be
+    kept in memory.
+    """
+
+    def _gen():
+        buf = [json_dumps(key).join((b'{', b':['))]
+        size = 0
+        for i, item in enumerate(items):
+            data = json_dumps(item)
+            buf.append(b',' + data if i else data)
+            size += len(data)
+            if size >= buffer_size:
+                yield b''.join(buf)
+                buf = []
+                size = 0
+        buf.append(b']}')
+        yield b''.join(buf)
+
+    return current_app.response_class(_gen(), mimetype='application/json')
+
+
+def _get_compressor(encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=4)
+        return compressor.process, compressor.finish
+    # gzip container
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+
+def compress_response(response):
+    """Compress a JSON response if the client supports it.
+
+    Streamed responses are compressed while they are sent, others only if
+    they are larger than `COMPRESS_MIN_SIZE`.
+    """
+    if (
+        response.mimetype != 'application/json'
+        or response.direct_passthrough
+        or 'Content-Encoding' in response.headers
+        or response.status_code != 200
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not response.is_streamed and response.content_length < COMPRESS_MIN_SIZE:
+        return response
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+    if encoding is None:
+        return response
+    compress, flush = _get_compressor(encoding)
+    if response.is_streamed:
+        chunks = response.response
+
+        def _gen():
+            for chunk in chunks:
+                if data := compress(chunk):
+                    yield data
+            yield flush()
+
+        response.response = _gen()
+    else:
+        response.set_data(compress(response.get_data()) + flush())
+    response.content_encoding = encoding
+    return response
+
+
 def bool_arg(arg):
     return arg in ('yes', 'true', '1')
 
@@ -53,7 +148,7 @@ def rest(f):
     def wrapper(*args, **kwargs):
         ret = f(*args, **kwargs)
         if ret is None:
-            response = '', 204
+            return '', 204
         elif isinstance(ret, current_app.response_class):
             response = ret
         elif isinstance(ret, tuple):
@@ -65,13 +160,74 @@ def rest(f):
             response.status_code = ret[0]
         else:
             response = jsonify(**ret)
-        return response
+        return compress_response(response)
 
     return wrapper
 
 
+class LRUCache:
+    """A least-recently-used cache limited by the total size of its values."""
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.size = 0
+        self._sizeof = sizeof
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def set(self, key, value):
+        self.discard(key)
+        size = self._sizeof(value)
+        if size > self.max_size:
+            return
+        self._data[key] = value
+        self.size += size
+        while self.size > self.max_size:
+            __, old = self._data.popitem(last=False)
+            self.size -= self._sizeof(old)
+
+    def discard(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return
+        self.size -= self._sizeof(value)
+
+    def discard_where(self, predicate):
+        for key in [key for key in self._data if predicate(key)]:
+            self.discard(key)
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+
 def get_version():
     try:
         return 'v' + pkg_resources.get_distribution('maildump').version
     except pkg_resources.DistributionNotFound:
         return 'dev'
+
+
+def reuse_port_listener(host, port, backlog):
+    """Create a listening socket other processes may listen on as well.
+
+    The kernel distributes incoming connections between all processes
+    listening on the port (``SO_REUSEPORT``).
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
@@ -1,26 +1,73 @@
+import codecs
+import html
+import math
 import re
+import time
 from io import BytesIO
+from urllib.parse import quote
 
 import bs4
-from flask import Flask, abort, render_template, request, send_file, url_for
+from flask import Flask, abort, g, render_template, request, send_file, url_for
 from logbook import Logger
 
 import maildump
-from maildump import db
-from maildump.util import bool_arg, get_version, rest
-from maildump.web_realtime import handle_sse_request
+from maildump import db, metrics
+from maildump.util import LRUCache, bool_arg, get_version, jsonify_stream, rest
+from maildump.web_realtime import get_next_event, handle_sse_request
 
 RE_CID = re.compile(r'(?P<replace>cid:(?P<cid>.+))')
 RE_CID_URL = re.compile(r'url\(\s*(?P<quote>["\']?)(?P<replace>cid:(?P<cid>[^\\\')]+))(?P=quote)\s*\)')
+RE_HTML_TOKEN = re.compile(
+    r"""
+    <!--.*?-->
+    | <(?P<raw>script|style|textarea|title)\b(?P<raw_attrs>(?:[^>"']|"[^"]*"|'[^']*')*)>(?P<content>.*?)</(?P=raw)\s*>
+    | <(?P<tag>[a-z][^\s/>]*)(?:[^>"']|"[^"]*"|'[^']*')*>
+    """,
+    re.DOTALL | re.IGNORECASE | re.VERBOSE,
+)
+RE_HTML_ATTR = re.compile(r"""(?P<name>\s[^\s"'>/=]+\s*=\s*)(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<uq>[^\s"'=<>`]+))""")
+HTML_CACHE_SIZE = 33554432
+IMMUTABLE_MAX_AGE = 31536000
+TRANSCODE_CHUNK_SIZE = 65536
+PAGE_LIMIT = 1000
+SEARCH_LIMIT = 500
+WAIT_TIMEOUT = 30
+MAX_WAIT_TIMEOUT = 300
+READ_ONLY_MSG = 'messages can only be deleted through the process receiving them'
 
 # Flask app
 app = Flask(__name__, static_folder='static/dist', static_url_path='/static')
 app._logger = log = Logger(__name__)
 app.add_url_rule('/event-stream', view_func=handle_sse_request)
+# HTML bodies with rewritten cid links, keyed by message id
+_html_cache = LRUCache(HTML_CACHE_SIZE, sizeof=lambda x: len(x[1]))
+db.register_cache(_html_cache)
+
+REQUEST_SECONDS = metrics.Histogram(
+    'maildump_http_request_seconds', 'Time spent handling HTTP requests until the response is returned', ('endpoint',)
+)
+REQUESTS = metrics.Counter('maildump_http_requests_total', 'Handled HTTP requests', ('endpoint', 'status'))
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    # streamed bodies are sent after this, so only the time until the
+    # response starts is measured
+    endpoint = request.endpoint or '<unmatched>'
+    REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - g.request_start)
+    REQUESTS.labels(endpoint, response.status_code).inc()
+    return response
 
 
 @app.before_request
 def check_auth():
+    if request.endpoint == 'get_metrics' and not app.config['MAILDUMP_METRICS_AUTH']:
+        return
     htpasswd = app.config['MAILDUMP_HTPASSWD']
     if htpasswd is None:
         # Authentication disabled
@@ -39,6 +86,11 @@ def home():
     return render_template('index.parcel.html', version=get_version())
 
 
+@app.route('/metrics', methods=('GET',))
+def get_metrics():
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/', methods=('DELETE',))
 @rest
 def terminate():
@@ -51,14 +103,25 @@ def terminate():
 @app.route('/messages/', methods=('DELETE',))
 @rest
 def delete_messages():
+    if db.is_read_only():
+        return 403, READ_ONLY_MSG
     db.delete_messages()
 
 
 @app.route('/messages/', methods=('GET',))
 @rest
 def get_messages():
+    if 'q' in request.args:
+        limit = min(max(request.args.get('limit', SEARCH_LIMIT, type=int), 1), SEARCH_LIMIT)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        return {'messages': db.search_messages(request.args['q'], limit, offset), 'limit': limit, 'offset': offset}
     lightweight = not bool_arg(request.args.get('full'))
-    return {'messages': db.get_messages(lightweight)}
+    if 'before' in request.args or 'limit' in request.args:
+        before = request.args.get('before', type=int)
+        limit = min(max(request.args.get('limit', PAGE_LIMIT, type=int), 1), PAGE_LIMIT)
+        messages = db.get_messages(lightweight, before, limit)
+        return {'messages': messages, 'next': messages[-1]['id'] if len(messages) == limit else None}
+    return jsonify_stream('messages', db.iter_messages(lightweight))
 
 
 @app.route('/messages/<int:message_id>', methods=('DELETE',))
@@ -67,57 +130,177 @@ def delete_message(message_id):
     message = db.get_message(message_id, True)
     if not message:
         return 404, 'message does not exist'
+    if db.is_read_only():
+        return 403, READ_ONLY_MSG
     db.delete_message(message_id)
 
 
+def _url_for(endpoint, **kwargs):
+    # Messages never change and their ids are never reused within a database, so
+    # resources requested with the instance id of the database can be cached forever
+    return url_for(endpoint, v=db.get_instance_id(), **kwargs)
+
+
 def _part_url(part):
-    return url_for('get_message_part', message_id=part['message_id'], cid=part['cid'])
+    return _url_for('get_message_part', message_id=part['message_id'], cid=part['cid'])
 
 
-def _part_response(part, body=None, charset=None):
-    charset = charset or part['charset'] or 'utf-8'
-    if body is None:
-        body = part['body']
-    if charset != 'utf-8':
-        body = body.decode(charset).encode('utf-8')
-    io = BytesIO(body)
-    io.seek(0)
-    response = send_file(io, part['type'], part['is_attachment'], part['filename'])
-    response.charset = charset
+def _get_etag(message_id, kind):
+    return '{}-{}-{}'.format(db.get_instance_id(), message_id, quote(kind, safe=''))
+
+
+def _set_cache_headers(response):
+    response.cache_control.private = True
+    if request.args.get('v') == db.get_instance_id():
+        response.cache_control.no_cache = None
+        response.cache_control.public = None
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
     return response
 
 
+def _not_modified(message_id, etag):
+    # Avoid loading a resource the client already has
+    if etag not in request.if_none_match or not db.get_message(message_id, True):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return _set_cache_headers(response)
+
+
+def _send_file(file, size, mimetype, etag, as_attachment=False, filename=None, charset=None):
+    response = send_file(file, mimetype, as_attachment, filename, etag=etag, conditional=False)
+    if charset:
+        response.content_type = f'{mimetype}; charset={charset}'
+    response.content_length = size
+    response = response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+    return _set_cache_headers(response)
+
+
+def _transcode(file, charset):
+    decoder = codecs.getincrementaldecoder(charset)('replace')
+    with file:
+        while chunk := file.read(TRANSCODE_CHUNK_SIZE):
+            yield decoder.decode(chunk).encode('utf-8')
+        yield decoder.decode(b'', final=True).encode('utf-8')
+
+
+def _get_codec(charset):
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
+
+def _part_response(part, etag, body=None, charset=None):
+    """Send a message part.
+
+    The body is streamed from the file in the `body` of the part unless
+    `body` is passed explicitly. Text parts which are not attachments are
+    converted to UTF-8 while sending them.
+    """
+    file, size = (part['body'], part['size']) if body is None else (BytesIO(body), len(body))
+    charset = charset or part['charset'] or 'utf-8'
+    mimetype = part['type']
+    if not mimetype.startswith('text/') or not (codec := _get_codec(charset)):
+        return _send_file(file, size, mimetype, etag, part['is_attachment'], part['filename'])
+    elif part['is_attachment'] or codec in {'utf-8', 'ascii'}:
+        # attachments are sent exactly as they have been received
+        return _send_file(file, size, mimetype, etag, part['is_attachment'], part['filename'], charset)
+    response = app.response_class(_transcode(file, codec), mimetype=mimetype)
+    response.set_etag(etag)
+    response = response.make_conditional(request.environ)
+    return _set_cache_headers(response)
+
+
+def _message_info(message):
+    message_id = message['id']
+    message['href'] = _url_for('get_message_eml', message_id=message_id)
+    message['formats'] = {'source': _url_for('get_message_source', message_id=message_id)}
+    if message.pop('has_plain'):
+        message['formats']['plain'] = _url_for('get_message_plain', message_id=message_id)
+    if message.pop('has_html'):
+        message['formats']['html'] = _url_for('get_message_html', message_id=message_id)
+    message['attachments'] = [dict(part, href=_part_url(part)) for part in message['attachments']]
+    return message
+
+
 @app.route('/messages/<int:message_id>.json', methods=('GET',))
 @rest
 def get_message_info(message_id):
     lightweight = not bool_arg(request.args.get('full'))
-    message = db.get_message(message_id, lightweight)
+    message = db.get_message(message_id, lightweight, info=True)
     if not message:
         return 404, 'message does not exist'
-    message['href'] = url_for('get_message_eml', message_id=message_id)
-    message['formats'] = {'source': url_for('get_message_source', message_id=message_id)}
-    if db.message_has_plain(message_id):
-        message['formats']['plain'] = url_for('get_message_plain', message_id=message_id)
-    if db.message_has_html(message_id):
-        message['formats']['html'] = url_for('get_message_html', message_id=message_id)
-    message['attachments'] = [dict(part, href=_part_url(part)) for part in db.get_message_attachments(message_id)]
-    return message
+    return _message_info(message)
+
+
+@app.route('/messages/info', methods=('GET',))
+@rest
+def get_messages_info():
+    try:
+        message_ids = [int(x) for x in request.args.get('ids', '').split(',') if x.strip()]
+    except ValueError:
+        return 400, 'invalid message ids'
+    if len(message_ids) > PAGE_LIMIT:
+        return 400, f'too many message ids (max {PAGE_LIMIT})'
+    lightweight = not bool_arg(request.args.get('full'))
+    return {'messages': [_message_info(message) for message in db.get_messages_info(message_ids, lightweight)]}
+
+
+@app.route('/messages/wait', methods=('GET',))
+@rest
+def wait_for_message():
+    """Wait for a message matching the given criteria.
+
+    Returns the first message with an id greater than `since` matching all
+    of `from`, `to`, `subject` and `subject~` (a substring), waiting up to
+    `timeout` seconds for one to arrive. If none arrives, 404 is returned.
+    """
+    try:
+        since = int(request.args.get('since', 0))
+        timeout = float(request.args.get('timeout', WAIT_TIMEOUT))
+    except ValueError:
+        return 400, 'invalid since or timeout'
+    if not math.isfinite(timeout) or timeout < 0:
+        return 400, 'invalid since or timeout'
+    timeout = min(timeout, MAX_WAIT_TIMEOUT)
+    criteria = {
+        'sender': request.args.get('from'),
+        'recipient': request.args.get('to'),
+        'subject': request.args.get('subject'),
+        'subject_contains': request.args.get('subject~'),
+    }
+    deadline = time.monotonic() + timeout
+    while True:
+        next_event = get_next_event()
+        message = db.find_message(since, **criteria)
+        if message:
+            return _message_info(message)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not next_event.wait(remaining):
+            return 404, 'no matching message'
 
 
 @app.route('/messages/<int:message_id>.plain', methods=('GET',))
 @rest
 def get_message_plain(message_id):
-    part = db.get_message_part_plain(message_id)
+    etag = _get_etag(message_id, 'plain')
+    if response := _not_modified(message_id, etag):
+        return response
+    part = db.open_message_part_plain(message_id)
     if not part:
         return 404, 'part does not exist'
-    return _part_response(part)
+    return _part_response(part, etag)
 
 
 def _fix_cid_links(soup, message_id):
     def _url_from_cid_match(m):
         return m.group().replace(
             m.group('replace'),
-            url_for('get_message_part', message_id=message_id, cid=m.group('cid')),
+            _url_for('get_message_part', message_id=message_id, cid=m.group('cid')),
         )
 
     # Iterate over all attributes that do not contain CSS and replace cid references
@@ -133,44 +316,119 @@ def _fix_cid_links(soup, message_id):
         tag.string = RE_CID_URL.sub(_url_from_cid_match, tag.string)
 
 
+def _rewrite_cid_links(text, message_id):
+    """Rewrite cid references without parsing the whole document.
+
+    Only attributes and ``<style>`` elements containing ``cid:`` are
+    touched; everything else is returned as-is. Raises `ValueError` if
+    the markup cannot be handled this way.
+    """
+
+    def _url_from_cid_match(m):
+        return m.group().replace(
+            m.group('replace'),
+            _url_for('get_message_part', message_id=message_id, cid=m.group('cid')),
+        )
+
+    def _rewrite_attr(m):
+        quote = '"' if m.group('dq') is not None else "'" if m.group('sq') is not None else ''
+        value = html.unescape(m.group(m.lastgroup))
+        if not (cid_match := RE_CID.match(value)):
+            return m.group()
+        return '{}{}{}{}'.format(m.group('name'), quote, html.escape(_url_from_cid_match(cid_match)), quote)
+
+    def _rewrite_token(m):
+        token = m.group()
+        if m.group('tag') and m.group('tag').lower() in {'script', 'style', 'textarea', 'title'}:
+            # raw text elements are only matched as a tag if they are never closed
+            raise ValueError(f'unclosed <{m.group("tag")}> element')
+        elif 'cid:' not in token:
+            return token
+        elif m.group('tag'):
+            return RE_HTML_ATTR.sub(_rewrite_attr, token)
+        elif not m.group('raw'):
+            # comment
+            return token
+        # the content of raw text elements is only rewritten for stylesheets
+        content_start = m.start('content') - m.start()
+        content_end = m.end('content') - m.start()
+        content = token[content_start:content_end]
+        if m.group('raw').lower() == 'style':
+            content = RE_CID_URL.sub(_url_from_cid_match, content)
+        return RE_HTML_ATTR.sub(_rewrite_attr, token[:content_start]) + content + token[content_end:]
+
+    if 'cid:' not in text:
+        return text
+    return RE_HTML_TOKEN.sub(_rewrite_token, text)
+
+
+def _get_html(part, message_id):
+    charset = part['charset'] or 'utf-8'
+    text = part['body'].decode(charset)
+    try:
+        return _rewrite_cid_links(text, message_id).encode('utf-8')
+    except ValueError as exc:
+        log.debug(f'Using html5lib to rewrite the HTML of message {message_id}: {exc}')
+    soup = bs4.BeautifulSoup(text, 'html5lib')
+    _fix_cid_links(soup, message_id)
+    return soup.encode('utf-8')
+
+
 @app.route('/messages/<int:message_id>.html', methods=('GET',))
 @rest
 def get_message_html(message_id):
+    etag = _get_etag(message_id, 'html')
+    if cached := _html_cache.get((message_id,)):
+        part, body = cached
+        return _part_response(part, etag, body, 'utf-8')
+    if response := _not_modified(message_id, etag):
+        return response
     part = db.get_message_part_html(message_id)
     if not part:
         return 404, 'part does not exist'
-    charset = part['charset'] or 'utf-8'
-    soup = bs4.BeautifulSoup(part['body'].decode(charset), 'html5lib')
-    _fix_cid_links(soup, message_id)
-    return _part_response(part, soup.encode('utf-8'), 'utf-8')
+    body = _get_html(part, message_id)
+    part = {k: part[k] for k in ('type', 'is_attachment', 'filename')}
+    _html_cache.set((message_id,), (part, body))
+    return _part_response(part, etag, body, 'utf-8')
+
+
+def _source_response(message_id, kind, mimetype):
+    etag = _get_etag(message_id, kind)
+    if response := _not_modified(message_id, etag):
+        return response
+    # Compressed sources can be sent as they are stored, but ranges always refer to the uncompressed data
+    accepted = set() if request.range else {value for value, quality in request.accept_encodings if quality}
+    source, size, content_encoding = db.open_message_source(message_id, accepted)
+    if source is None:
+        return 404, 'message does not exist'
+    if content_encoding:
+        etag = f'{etag}-{content_encoding}'
+    response = _send_file(source, size, mimetype, etag)
+    if content_encoding:
+        response.content_encoding = content_encoding
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 @app.route('/messages/<int:message_id>.source', methods=('GET',))
 @rest
 def get_message_source(message_id):
-    message = db.get_message(message_id)
-    if not message:
-        return 404, 'message does not exist'
-    io = BytesIO(message['source'])
-    io.seek(0)
-    return send_file(io, 'text/plain')
+    return _source_response(message_id, 'source', 'text/plain')
 
 
 @app.route('/messages/<int:message_id>.eml', methods=('GET',))
 @rest
 def get_message_eml(message_id):
-    message = db.get_message(message_id)
-    if not message:
-        return 404, 'message does not exist'
-    io = BytesIO(message['source'])
-    io.seek(0)
-    return send_file(io, 'message/rfc822')
+    return _source_response(message_id, 'eml', 'message/rfc822')
 
 
 @app.route('/messages/<int:message_id>/parts/<cid>', methods=('GET',))
 @rest
 def get_message_part(message_id, cid):
-    part = db.get_message_part_cid(message_id, cid)
+    etag = _get_etag(message_id, f'part-{cid}')
+    if response := _not_modified(message_id, etag):
+        return response
+    part = db.open_message_part(message_id, cid)
     if not part:
         return 404, 'part does not exist'
-    return _part_response(part)
+    return _part_response(part, etag)
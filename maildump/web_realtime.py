@@ -1,35 +1,178 @@
-from flask import current_app
-from gevent.queue import Empty, Queue
+import time
+import uuid
+from collections import deque
+
+from flask import current_app, request
+from gevent.event import Event
+from gevent.queue import Empty, Full, Queue
+from logbook import Logger
+
+from maildump import metrics
+from maildump.util import json_dumps
+
+log = Logger(__name__)
+
+# Number of events a client may lag behind before it is disconnected
+QUEUE_SIZE = 1000
+# Idle clients are pinged after this many seconds; this is also when
+# vanished clients are noticed
+PING_INTERVAL = 30
+# Number of recent events kept to be replayed to reconnecting clients
+REPLAY_SIZE = 1000
 
 clients = set()
+# Event ids consist of an epoch and an increasing number. Processes sharing
+# a database use its instance id and the ids of its event log, so an event
+# has the same id in all of them, see `use_event_log`. Otherwise the epoch
+# is unique to this process and ids from other processes are never mistaken
+# for our own ones.
+_epoch = uuid.uuid4().hex
+_last_event_number = 0
+# The most recent ``(event_number, frame)`` tuples
+_history = deque(maxlen=REPLAY_SIZE)
+# Set (and replaced) whenever an event is broadcast
+_next_event = Event()
 
+BROADCAST_SECONDS = metrics.Histogram('maildump_sse_broadcast_seconds', 'Time spent broadcasting an event')
+EVENTS = metrics.Counter('maildump_sse_events_total', 'Events broadcast to event stream clients', labels=('event',))
+metrics.Gauge('maildump_sse_clients', 'Connected event stream clients', lambda: len(clients))
+metrics.Gauge(
+    'maildump_sse_queued_events', 'Events waiting to be sent to clients', lambda: sum(c.queue.qsize() for c in clients)
+)
+metrics.Gauge(
+    'maildump_sse_max_queued_events',
+    'Events waiting to be sent to the slowest client',
+    lambda: max((c.queue.qsize() for c in clients), default=0),
+)
+DROPPED_CLIENTS = metrics.Counter('maildump_sse_dropped_clients_total', 'Clients disconnected for being too slow')
 
-def broadcast(event, data=None):
-    for q in clients:
-        q.put((event, data))
 
+class _Client:
+    __slots__ = ('queue',)
 
-def handle_sse_request():
-    return current_app.response_class(_gen(), mimetype='text/event-stream')
+    def __init__(self):
+        self.queue = Queue(QUEUE_SIZE)
 
+    def close(self):
+        """Replace all pending events with the end-of-stream marker."""
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+        self.queue.put_nowait(None)
 
-def _gen():
-    yield _sse('connected')
-    q = Queue()
-    clients.add(q)
-    while True:
-        try:
-            msg = q.get(timeout=60)
-        except Empty:
-            yield _sse('ping')
-            continue
+
+def use_event_log(epoch, last_event_number):
+    """Use the ids of an event log shared with other processes.
+
+    `last_event_number` is the id of the most recent event in the log. The
+    events broadcast afterwards must pass their ids from the log.
+    """
+    global _epoch, _last_event_number
+    _epoch = epoch
+    _last_event_number = last_event_number
+    _history.clear()
+
+
+def broadcast(event, data=None, event_number=None):
+    """Send an event to all connected clients.
+
+    `data` may be anything that can be serialized to JSON. `event_number`
+    is the id of the event in the shared event log, if any. The event is
+    encoded once and shared by all clients. Clients whose queue is full are
+    disconnected instead of buffering events for them forever; browsers
+    reconnect automatically and catch up using the replayed events.
+    """
+    global _last_event_number, _next_event
+    start = time.perf_counter()
+    _last_event_number = _last_event_number + 1 if event_number is None else event_number
+    frame = _sse(event, data, _last_event_number)
+    _history.append((_last_event_number, frame))
+    for client in list(clients):
         try:
-            yield _sse(*msg)
-        except GeneratorExit:
-            clients.remove(q)
-            raise
+            client.queue.put_nowait(frame)
+        except Full:
+            log.warning('Disconnecting slow event stream client')
+            clients.discard(client)
+            client.close()
+            DROPPED_CLIENTS.inc()
+    EVENTS.labels(event).inc()
+    BROADCAST_SECONDS.observe(time.perf_counter() - start)
+    event, _next_event = _next_event, Event()
+    event.set()
+
 
+def get_next_event():
+    """Get a gevent `Event` that is set once the next event is broadcast.
 
-def _sse(event, data=None):
-    parts = [f'event: {event}', f'data: {data or ""}']
+    Get it before checking whatever the event may change to avoid missing
+    an event broadcast in between.
+    """
+    return _next_event
+
+
+def handle_sse_request():
+    # the generator runs after the request context is gone
+    last_event_id = request.headers.get('Last-Event-ID')
+    return current_app.response_class(_gen(last_event_id), mimetype='text/event-stream')
+
+
+def _get_replay(last_event_id):
+    """Get the frames of the events a reconnecting client missed.
+
+    Returns ``None`` if they are not available anymore, or if the id is
+    from a different epoch, e.g. from a process not sharing our database.
+    """
+    epoch, __, number = (last_event_id or '').rpartition('-')
+    if epoch != _epoch:
+        return None
+    try:
+        number = int(number)
+    except ValueError:
+        return None
+    oldest = _history[0][0] if _history else _last_event_number + 1
+    if not oldest - 1 <= number <= _last_event_number:
+        return None
+    return [frame for event_number, frame in _history if event_number > number]
+
+
+def _gen(last_event_id):
+    # registering the client and taking the replay snapshot happens without
+    # yielding, so the client neither misses nor duplicates any events
+    replay = _get_replay(last_event_id)
+    client = _Client()
+    clients.add(client)
+    log.debug(f'Event stream client connected ({len(clients)} total)')
+    try:
+        if replay is None:
+            # the client needs to reload everything; the id lets it resume
+            # from here if it reconnects later
+            yield _sse('connected', event_number=_last_event_number)
+        else:
+            yield _RESUMED
+            yield from replay
+        while True:
+            try:
+                frame = client.queue.get(timeout=PING_INTERVAL)
+            except Empty:
+                frame = _PING
+            if frame is None:
+                return
+            yield frame
+    finally:
+        # runs when the stream ends, the client has been dropped or the
+        # server could not write to a client that went away
+        clients.discard(client)
+        log.debug(f'Event stream client disconnected ({len(clients)} total)')
+
+
+def _sse(event, data=None, event_number=None):
+    parts = [f'event: {event}', f'data: {json_dumps(data).decode() if data is not None else ""}']
+    if event_number is not None:
+        parts.insert(0, f'id: {_epoch}-{event_number}')
     return ('\r\n'.join(parts) + '\r\n\r\n').encode()
+
+
+_PING = _sse('ping')
+_RESUMED = _sse('resumed')
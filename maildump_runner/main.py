@@ -1,6 +1,7 @@
 import argparse
 import os
 import signal
+import socket
 import sys
 from pathlib import Path
 
@@ -20,6 +21,16 @@ def read_pidfile(path):
         raise ValueError(e.message)
 
 
+def parse_duration(value):
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    try:
+        if value[-1:].lower() in units:
+            return int(value[:-1]) * units[value[-1].lower()]
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid duration: {value}') from None
+
+
 def terminate_server(sig, frame):
     from maildump import stop
 
@@ -29,14 +40,156 @@ def terminate_server(sig, frame):
     stop()
 
 
+def request_snapshot(sig, frame):
+    from maildump import snapshot
+
+    snapshot.request()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--smtp-ip', default='127.0.0.1', metavar='IP', help='SMTP ip (default: 127.0.0.1)')
     parser.add_argument('--smtp-port', default=1025, type=int, metavar='PORT', help='SMTP port (default: 1025)')
+    parser.add_argument('--smtp-backlog', default=128, type=int, metavar='N', help='SMTP listen backlog (default: 128)')
+    parser.add_argument(
+        '--smtp-max-connections',
+        type=int,
+        metavar='N',
+        help='Maximum number of concurrent SMTP sessions (default: unlimited)',
+    )
+    parser.add_argument(
+        '--smtp-workers',
+        default=0,
+        type=int,
+        metavar='N',
+        help='Receive and decode messages in N worker processes sharing the SMTP port (default: 0, i.e. in the '
+        'main process)',
+    )
+    parser.add_argument(
+        '--smtp-spool-threshold',
+        default=1048576,
+        type=int,
+        metavar='BYTES',
+        help='Spool incoming messages larger than this to disk (default: 1048576)',
+    )
+    parser.add_argument(
+        '--ingest-queue-size',
+        default=1000,
+        type=int,
+        metavar='N',
+        help='Maximum number of messages waiting to be stored before new ones are rejected (default: 1000)',
+    )
+    parser.add_argument(
+        '--ingest-batch-size',
+        default=100,
+        type=int,
+        metavar='N',
+        help='Maximum number of messages stored in a single transaction (default: 100)',
+    )
+    parser.add_argument(
+        '--ingest-max-delay',
+        default=0.05,
+        type=float,
+        metavar='SECONDS',
+        help='Maximum time a received message waits before being stored (default: 0.05)',
+    )
+    parser.add_argument(
+        '--parse-workers',
+        default=2,
+        type=int,
+        metavar='N',
+        help='Number of threads decoding the MIME parts of received messages (default: 2)',
+    )
     parser.add_argument('--http-ip', default='127.0.0.1', metavar='IP', help='HTTP ip (default: 127.0.0.1)')
     parser.add_argument('--http-port', default=1080, type=int, metavar='PORT', help='HTTP port (default: 1080)')
     parser.add_argument('--db', metavar='PATH', help='SQLite database - in-memory if missing')
+    parser.add_argument(
+        '--db-synchronous',
+        default='NORMAL',
+        choices=('OFF', 'NORMAL', 'FULL'),
+        type=str.upper,
+        help='SQLite synchronous mode (default: NORMAL)',
+    )
+    parser.add_argument(
+        '--db-cache-size', default=16384, type=int, metavar='KIB', help='SQLite page cache size (default: 16384)'
+    )
+    parser.add_argument(
+        '--db-mmap-size',
+        default=0,
+        type=int,
+        metavar='BYTES',
+        help='Maximum size of the database file mapped into memory (default: 0)',
+    )
+    parser.add_argument(
+        '--db-readers',
+        default=4,
+        type=int,
+        metavar='N',
+        help='Number of read-only database connections used by the web interface (default: 4)',
+    )
+    parser.add_argument(
+        '--snapshot-interval',
+        type=parse_duration,
+        metavar='DURATION',
+        help='Keep the database in memory and save it to --db in this interval (e.g. 60, 5m), on shutdown and on '
+        'SIGUSR1 (default: disabled)',
+    )
+    parser.add_argument(
+        '--part-storage',
+        default='copy',
+        choices=('copy', 'index'),
+        help='Store decoded message parts (copy) or decode them from the message source when needed (index) '
+        '(default: copy)',
+    )
+    parser.add_argument(
+        '--part-cache-size',
+        default=33554432,
+        type=int,
+        metavar='BYTES',
+        help='Size of the cache for parts decoded from the message source (default: 33554432)',
+    )
+    parser.add_argument(
+        '--compression',
+        default='none',
+        choices=('none', 'zlib', 'zstd'),
+        help='Compress stored message sources and text parts (default: none; zstd requires the zstandard package)',
+    )
+    parser.add_argument(
+        '--max-messages',
+        type=int,
+        metavar='N',
+        help='Delete the oldest messages beyond this number (default: unlimited)',
+    )
+    parser.add_argument(
+        '--max-bytes',
+        type=int,
+        metavar='BYTES',
+        help='Delete the oldest messages once their total size exceeds this (default: unlimited)',
+    )
+    parser.add_argument(
+        '--max-age',
+        type=parse_duration,
+        metavar='DURATION',
+        help='Delete messages older than this, e.g. 3600, 90m, 12h or 7d (default: unlimited)',
+    )
+    parser.add_argument(
+        '--role',
+        default='all',
+        choices=('all', 'smtp', 'web'),
+        help='Run only the SMTP server (smtp) or only the web server (web), so several processes can share a '
+        'database. Web processes open it read-only and cannot delete messages (default: all)',
+    )
+    parser.add_argument(
+        '--reuse-port',
+        action='store_true',
+        help='Allow several processes to listen on the HTTP port (SO_REUSEPORT)',
+    )
     parser.add_argument('--htpasswd', metavar='HTPASSWD', help='Apache-style htpasswd file')
+    parser.add_argument(
+        '--metrics-no-auth',
+        action='store_true',
+        help='Do not require authentication for /metrics (only relevant with --htpasswd)',
+    )
     parser.add_argument('-v', '--version', help='Display the version and exit', action='store_true')
     parser.add_argument(
         '-f',
@@ -91,6 +244,26 @@ def main():
         args.htpasswd = os.path.abspath(args.htpasswd)
         print(f'Htpasswd path is relative, using {args.htpasswd}')
 
+    if args.role != 'all' and not args.db:
+        print(f'The {args.role} role requires a database file shared with the other processes')
+        sys.exit(1)
+    if args.snapshot_interval and not args.db:
+        print('Snapshots require a database file (--db)')
+        sys.exit(1)
+    if args.snapshot_interval and args.role != 'all':
+        print('Snapshots cannot be used with a database shared with other processes (--role)')
+        sys.exit(1)
+    if (args.reuse_port or args.smtp_workers) and not hasattr(socket, 'SO_REUSEPORT'):
+        print('SO_REUSEPORT is not supported on this platform')
+        sys.exit(1)
+
+    if args.compression == 'zstd':
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            print('zstd compression requires the zstandard package')
+            sys.exit(1)
+
     # Check if the password file is valid
     if args.htpasswd and not os.path.isfile(args.htpasswd):
         print('Htpasswd file does not exist')
@@ -98,7 +271,11 @@ def main():
 
     daemon_kw = {
         'monkey_greenlet_report': False,
-        'signal_map': {signal.SIGTERM: terminate_server, signal.SIGINT: terminate_server},
+        'signal_map': {
+            signal.SIGTERM: terminate_server,
+            signal.SIGINT: terminate_server,
+            signal.SIGUSR1: request_snapshot,
+        },
     }
 
     if args.foreground:
@@ -147,13 +324,41 @@ def main():
                 raise
             app.config['MAILDUMP_HTPASSWD'] = HtpasswdFile(args.htpasswd)
         app.config['MAILDUMP_NO_QUIT'] = args.no_quit
+        app.config['MAILDUMP_METRICS_AUTH'] = not args.metrics_no_auth
 
         level = logbook.DEBUG if args.debug else logbook.INFO
         format_string = '[{record.time:%Y-%m-%d %H:%M:%S}]  {record.level_name:<8}  {record.channel}: {record.message}'
         stderr_handler = ColorizedStderrHandler(level=level, format_string=format_string)
         with NullHandler().applicationbound():
             with stderr_handler.applicationbound():
-                start(args.http_ip, args.http_port, args.smtp_ip, args.smtp_port, args.db)
+                start(
+                    args.http_ip,
+                    args.http_port,
+                    args.smtp_ip,
+                    args.smtp_port,
+                    args.db,
+                    db_synchronous=args.db_synchronous,
+                    db_cache_size=args.db_cache_size,
+                    db_mmap_size=args.db_mmap_size,
+                    db_readers=args.db_readers,
+                    part_storage=args.part_storage,
+                    part_cache_size=args.part_cache_size,
+                    compression=args.compression if args.compression != 'none' else None,
+                    smtp_backlog=args.smtp_backlog,
+                    smtp_max_connections=args.smtp_max_connections,
+                    smtp_spool_threshold=args.smtp_spool_threshold,
+                    ingest_queue_size=args.ingest_queue_size,
+                    ingest_batch_size=args.ingest_batch_size,
+                    ingest_max_delay=args.ingest_max_delay,
+                    parse_workers=args.parse_workers,
+                    max_messages=args.max_messages,
+                    max_bytes=args.max_bytes,
+                    max_age=args.max_age,
+                    role=args.role,
+                    reuse_port=args.reuse_port,
+                    smtp_workers_count=args.smtp_workers,
+                    snapshot_interval=args.snapshot_interval,
+                )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,51 @@
+import argparse
+import os
+import sys
+
+import logbook
+from logbook import NullHandler
+from logbook.more import ColorizedStderrHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Recompress the message sources and text parts stored in a MailDump database. '
+        'Stop MailDump before running this.'
+    )
+    parser.add_argument('--db', metavar='PATH', required=True, help='SQLite database')
+    parser.add_argument(
+        '--compression',
+        default='zlib',
+        choices=('none', 'zlib', 'zstd'),
+        help='Codec to use, or none to decompress everything (default: zlib)',
+    )
+    parser.add_argument('--vacuum', action='store_true', help='Rebuild the database file afterwards to shrink it')
+    parser.add_argument('-d', '--debug', help='Show progress', action='store_true')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db):
+        print('Database does not exist')
+        sys.exit(1)
+
+    from maildump import db
+
+    compression = args.compression if args.compression != 'none' else None
+    level = logbook.DEBUG if args.debug else logbook.INFO
+    with NullHandler().applicationbound(), ColorizedStderrHandler(level=level).applicationbound():
+        try:
+            db.connect(args.db, compression=compression)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        try:
+            before, after = db.recompress(compression)
+            print(f'Stored data: {before} bytes before, {after} bytes after')
+            if args.vacuum:
+                print('Vacuuming database')
+                db.vacuum()
+        finally:
+            db.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+from email.parser import BytesHeaderParser
+from io import BytesIO
+
+import pytest
+
+from maildump import db
+from maildump.web import app
+
+
+@pytest.fixture
+def database():
+    db.connect()
+    yield
+    db.disconnect()
+
+
+@pytest.fixture
+def client(database):
+    app.config.update(MAILDUMP_HTPASSWD=None, MAILDUMP_NO_QUIT=True, MAILDUMP_METRICS_AUTH=True)
+    return app.test_client()
+
+
+@pytest.fixture
+def store_message(database):
+    """Store a raw message including its parts and return its id."""
+
+    def _store_message(data, sender='sender@example.com', recipients=('recipient@example.com',)):
+        body = BytesIO(data)
+        headers = BytesHeaderParser().parsebytes(data)
+        message_id = db.add_messages([(sender, list(recipients), body, headers)])[0]
+        db.add_message_parts([(message_id, *db.extract_message_parts(body))])
+        return message_id
+
+    return _store_message
@@ -0,0 +1,37 @@
+import pytest
+
+from maildump import db
+
+MESSAGE = b'Subject: Hello\r\nFrom: sender@example.com\r\nTo: recipient@example.com\r\n\r\nHello world\r\n'
+
+
+@pytest.mark.parametrize('kind', ('source', 'eml'))
+def test_source_plain(client, store_message, kind):
+    message_id = store_message(MESSAGE)
+    resp = client.get(f'/messages/{message_id}.{kind}', headers={'Accept-Encoding': 'gzip, deflate, zstd'})
+    assert resp.status_code == 200
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == MESSAGE
+
+
+def test_source_compressed(client, store_message):
+    db.configure(compression='zlib')
+    try:
+        message_id = store_message(MESSAGE * 100)
+    finally:
+        db.configure()
+    resp = client.get(f'/messages/{message_id}.source', headers={'Accept-Encoding': 'deflate'})
+    assert resp.headers['Content-Encoding'] == 'deflate'
+    resp = client.get(f'/messages/{message_id}.source')
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == MESSAGE * 100
+
+
+@pytest.mark.parametrize(('limit', 'expected'), (('-1', 1), ('0', 1), ('2', 2), ('1000', 3)))
+def test_search_limit(client, store_message, monkeypatch, limit, expected):
+    monkeypatch.setattr('maildump.web.SEARCH_LIMIT', 3)
+    for __ in range(5):
+        store_message(MESSAGE)
+    resp = client.get('/messages/', query_string={'q': 'hello', 'limit': limit})
+    assert resp.json['limit'] == expected
+    assert len(resp.json['messages']) == expected